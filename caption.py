@@ -39,7 +39,21 @@ bl_info = {
 }
 
 import bpy
+import bisect
+import hashlib
+import json
 import math
+import os
+import platform
+import re
+import shutil
+import tempfile
+import time
+import numpy as np
+from bpy.app.handlers import persistent
+from bpy_extras.io_utils import ImportHelper
+from bpy_extras.object_utils import world_to_camera_view
+from mathutils import Vector
 
 # 0-indexed
 FG_LAYER = 5
@@ -52,6 +66,15 @@ BG_LAYER_NAME = 'Caption Shadow'
 
 
 
+SHADOW_GROW = 3 # pixels a single pass shadow spreads past the text, about the shadow text's bevel
+
+# compositor_setup's node names
+COMPOSITE_NODE = 'Caption Output'
+CLIP_NODE = 'Caption Footage'
+TEXT_MIX_NODE = 'Caption Text Mix'
+BLUR_SWITCH_NODE = 'Caption Blur Switch'
+
+
 FG_LAYER_MASK = [False]*20
 BG_LAYER_MASK = [False]*20
 FG_LAYER_MASK[FG_LAYER] = True
@@ -79,7 +102,8 @@ def speedup_settings():
 	###
 	# Cycles
 	###
-	bpy.context.scene.cycles.device = 'GPU'
+	# a guess until calibrated, see CaptionCalibrate
+	bpy.context.scene.cycles.device = 'GPU' if gpu_available() else 'CPU'
 
 	# Speed up rendering with minimal bounces
 	bpy.context.scene.cycles.transparent_max_bounces=0
@@ -95,7 +119,7 @@ def speedup_settings():
 	bpy.context.scene.cycles.samples = 25
 	bpy.context.scene.cycles.preview_samples = 10
 
-	# large tiles for better GPU rendering
+	# large tiles for better GPU rendering, also a guess until calibrated
 	bpy.context.scene.render.tile_x = 256
 	bpy.context.scene.render.tile_y = 256
 
@@ -110,7 +134,7 @@ def speedup_settings():
 	bpy.context.scene.render.use_raytrace = False
 
 
-def scene_layers():
+def scene_layers(single_pass=False):
 	bpy.context.scene.layers[FG_LAYER] = True
 	bpy.context.scene.layers[BG_LAYER] = True
 
@@ -131,7 +155,9 @@ def scene_layers():
 		bpy.context.scene.render.layers[FG_LAYER_NAME].use_strand = False
 		bpy.context.scene.render.layers[FG_LAYER_NAME].use_sky = False
 
-	if not bg:
+	if bg:
+		bg.use = not single_pass
+	elif not single_pass:
 		bpy.ops.scene.render_layer_add()
 		bpy.context.scene.render.layers[1].name = BG_LAYER_NAME
 		bpy.context.scene.render.layers[BG_LAYER_NAME].layers = BG_LAYER_MASK
@@ -210,16 +236,19 @@ def material_nodes(mat, rgba):
 
 
 
-def make_text():
-	#create text objects
-	bpy.ops.object.text_add(radius=2, location=(0,0,0),rotation=(math.radians(90),0,0),layers=FG_LAYER_MASK)
+def make_text(body="Something", location=(0,0,0), shadow=True):
+	#create text objects. without a shadow, the compositor makes one
+	x, y, z = location
+	bpy.ops.object.text_add(radius=2, location=(x,y,z),rotation=(math.radians(90),0,0),layers=FG_LAYER_MASK)
 	fg = bpy.context.object
-	fg.data.body = "Something"
+	fg.data.body = body
 
-	bpy.ops.object.text_add(radius=2, location=(0,0.22,0),rotation=(math.radians(90),0,0),layers=BG_LAYER_MASK)
-	bg = bpy.context.object
-	bg.data.body = "Something"
-	bg.data.bevel_depth = 0.043	
+	bg = None
+	if shadow:
+		bpy.ops.object.text_add(radius=2, location=(x,y+0.22,z),rotation=(math.radians(90),0,0),layers=BG_LAYER_MASK)
+		bg = bpy.context.object
+		bg.data.body = body
+		bg.data.bevel_depth = 0.043	
 
 	white = None
 	black = None
@@ -239,9 +268,11 @@ def make_text():
 		black.diffuse_color = (0,0,0)
 
 	fg.data.materials.append(white)
-	bg.data.materials.append(black)
+	if bg:
+		bg.data.materials.append(black)
+	return fg, bg
 
-def compositor_setup():
+def compositor_setup(single_pass=False):
 	bpy.context.scene.use_nodes = True
 	comp = bpy.context.scene.node_tree
 
@@ -259,7 +290,6 @@ def compositor_setup():
 	end = comp.nodes.new('CompositorNodeComposite')
 	viewer = comp.nodes.new('CompositorNodeViewer')
 	render_white = comp.nodes.new('CompositorNodeRLayers')
-	render_black = comp.nodes.new('CompositorNodeRLayers')
 	text_mixer = comp.nodes.new('CompositorNodeAlphaOver')
 	clip = comp.nodes.new('CompositorNodeMovieClip')
 	clip_mixer = comp.nodes.new('CompositorNodeAlphaOver')
@@ -270,7 +300,6 @@ def compositor_setup():
 	end.location = (763,566)
 	viewer.location = (766,415)
 	render_white.location = (-132,395)
-	render_black.location = (-136,153)
 	text_mixer.location = (349,393)
 	clip.location = (-140,834)
 	clip_mixer.location = (551,530)
@@ -279,7 +308,33 @@ def compositor_setup():
 	switch.location = (228,233)
 
 	render_white.layer=FG_LAYER_NAME
-	render_black.layer=BG_LAYER_NAME
+
+	if single_pass:
+		###
+		# Shadow from the text's own alpha
+		#  grown out by about the shadow text's bevel, and painted black
+		###
+		shadow_offset = comp.nodes.new('CompositorNodeTranslate')
+		shadow_grow = comp.nodes.new('CompositorNodeDilateErode')
+		shadow_black = comp.nodes.new('CompositorNodeSetAlpha')
+		shadow_offset.location = (-136,153)
+		shadow_grow.location = (-136,0)
+		shadow_black.location = (-136,-120)
+
+		shadow_offset.label = "Shadow Offset"
+		shadow_grow.mode = 'DISTANCE'
+		shadow_grow.distance = SHADOW_GROW
+		shadow_black.inputs['Image'].default_value = (0,0,0,1)
+
+		comp.links.new(render_white.outputs['Alpha'],shadow_offset.inputs['Image'])
+		comp.links.new(shadow_offset.outputs['Image'],shadow_grow.inputs['Mask'])
+		comp.links.new(shadow_grow.outputs['Mask'],shadow_black.inputs['Alpha'])
+		shadow = shadow_black.outputs['Image']
+	else:
+		render_black = comp.nodes.new('CompositorNodeRLayers')
+		render_black.location = (-136,153)
+		render_black.layer=BG_LAYER_NAME
+		shadow = render_black.outputs['Image']
 
 	clip_size.space = 'RENDER_SIZE'
 	shadow_blur.filter_type = 'FAST_GAUSS'
@@ -289,36 +344,725 @@ def compositor_setup():
 
 	switch.label = "Enable Blur"
 
+	# for finding them again
+	end.name = COMPOSITE_NODE
+	clip.name = CLIP_NODE
+	text_mixer.name = TEXT_MIX_NODE
+	switch.name = BLUR_SWITCH_NODE
+
 	comp.links.new(clip.outputs['Image'],clip_size.inputs['Image'])
 	comp.links.new(clip_size.outputs['Image'],clip_mixer.inputs[1])
 	comp.links.new(clip_mixer.outputs['Image'],end.inputs['Image'])
 	comp.links.new(clip_mixer.outputs['Image'],viewer.inputs['Image'])
-	comp.links.new(render_black.outputs['Image'],shadow_blur.inputs['Image'])
-	comp.links.new(render_black.outputs['Image'],switch.inputs['Off'])
+	comp.links.new(shadow,shadow_blur.inputs['Image'])
+	comp.links.new(shadow,switch.inputs['Off'])
 	comp.links.new(shadow_blur.outputs['Image'],switch.inputs['On'])
 	comp.links.new(switch.outputs['Image'],text_mixer.inputs[1])
 	comp.links.new(render_white.outputs['Image'],text_mixer.inputs[2])
 	comp.links.new(text_mixer.outputs['Image'],clip_mixer.inputs[2])
 
 
+###
+# Subtitles
+#  cues from an SRT or ASS file are spread over a small pool of caption slots,
+#  each a text/shadow pair made by make_text. A slot holds cues that never
+#  overlap, so there are only as many slots as cues on screen at once. Every
+#  slot keeps its cues as JSON in its "caption_cues" property, and a frame
+#  change handler puts the current cue's text in the slot (nothing, between cues)
+###
+
+SLOT_SPACING = 2.0 # height between slots showing cues at the same time
+
+# parsed "caption_cues" by object name, reused until the property changes
+cue_tables = {}
+
+
+def cue_time(text):
+	# "h:mm:ss,mmm" (SRT) or "h:mm:ss.cc" (ASS) to seconds
+	seconds = 0.0
+	for part in text.strip().replace(',', '.').split(':'):
+		seconds = seconds*60 + float(part)
+	return seconds
+
+
+def srt_cues(lines):
+	timing = None
+	text = []
+	for line in lines:
+		line = line.rstrip('\r\n')
+		if '-->' in line:
+			start, end = line.split('-->')
+			timing = (cue_time(start), cue_time(end.split()[0]))
+			text = []
+		elif not line.strip():
+			if timing and text:
+				yield timing[0], timing[1], "\n".join(text)
+			timing = None
+		elif timing:
+			text.append(re.sub(r'<[^>]*>', '', line)) # <i>, <font ...> etc
+	if timing and text:
+		yield timing[0], timing[1], "\n".join(text)
+
+
+def ass_cues(lines):
+	fields = None
+	events = False
+	for line in lines:
+		line = line.strip()
+		if line.startswith('['):
+			events = line.lower() == '[events]'
+		elif events and line.lower().startswith('format:'):
+			fields = [field.strip().lower() for field in line[len('format:'):].split(',')]
+		elif events and fields and line.lower().startswith('dialogue:'):
+			cue = dict(zip(fields, line[len('dialogue:'):].split(',', len(fields)-1)))
+			text = re.sub(r'{[^}]*}', '', cue['text']) # override tags
+			text = text.replace('\\N', '\n').replace('\\n', '\n').replace('\\h', ' ')
+			yield cue_time(cue['start']), cue_time(cue['end']), text.strip()
+
+
+def read_cues(path):
+	# (start seconds, end seconds, text) for each cue, read a line at a time
+	with open(path, encoding='utf-8-sig', errors='replace') as f:
+		parse = ass_cues if os.path.splitext(path)[1].lower() in ('.ass', '.ssa') else srt_cues
+		for cue in parse(f):
+			yield cue
+
+
+def caption_slots(scene, count):
+	# the scene's caption slots, making more until there are at least count
+	slots = sorted((obj for obj in scene.objects if 'caption_slot' in obj), key=lambda obj: obj['caption_slot'])
+	for i in range(len(slots), count):
+		fg, bg = make_text("", location=(0,0,i*SLOT_SPACING), shadow=not scene.get('caption_single_pass'))
+		fg.name = "Caption {}".format(i+1)
+		fg['caption_slot'] = i
+		if bg:
+			bg.name = "Caption {} Shadow".format(i+1)
+			fg['caption_shadow'] = bg.name
+		slots.append(fg)
+	return slots
+
+
+def load_subtitles(path, scene, first_frame):
+	###
+	# Puts every cue in path on the first slot free by the time it starts,
+	#  first_frame being where the file's 0:00 lands. Returns how many cues
+	#  and how many slots that took
+	###
+	fps = scene.render.fps / scene.render.fps_base
+	slots = [] # [frame the slot is free from, its cues]
+	count = 0
+	for start, end, text in read_cues(path):
+		start = first_frame + int(round(start*fps))
+		end = first_frame + int(round(end*fps))
+		if end <= start or not text.strip():
+			continue
+		slot = next((slot for slot in slots if slot[0] <= start), None)
+		if slot is None:
+			slot = [0, []]
+			slots.append(slot)
+		slot[0] = max(slot[0], end)
+		slot[1].append((start, end, text))
+		count += 1
+
+	for i, obj in enumerate(caption_slots(scene, len(slots))):
+		obj['caption_cues'] = json.dumps(sorted(slots[i][1]) if i < len(slots) else [])
+	show_cues(scene)
+	return count, len(slots)
+
+
+def cue_table(obj):
+	raw = obj.get('caption_cues')
+	cached = cue_tables.get(obj.name)
+	if cached is None or cached[0] != raw:
+		cues = json.loads(raw)
+		cached = cue_tables[obj.name] = (raw, [cue[0] for cue in cues], cues)
+	return cached[1], cached[2]
+
+
+@persistent
+def show_cues(scene):
+	frame = scene.frame_current
+	for obj in scene.objects:
+		if 'caption_cues' not in obj:
+			continue
+		starts, cues = cue_table(obj)
+		i = bisect.bisect_right(starts, frame) - 1
+		body = cues[i][2] if i >= 0 and frame < cues[i][1] else ""
+		shadow = scene.objects.get(obj.get('caption_shadow', ""))
+		for text in (obj, shadow):
+			if text and text.data.body != body: # only touch what changed
+				text.data.body = body
+
+
+###
+# Deduplicated rendering
+#  captions sit still for dozens of frames at a time, so each frame's caption
+#  state is fingerprinted first (along with every render setting and the whole
+#  compositor tree, since the cache outlives them) and only frames with a new
+#  fingerprint get rendered, as a transparent overlay without the footage.
+#  Every frame then links to its overlay in an image sequence, composited over
+#  the footage in a separate "Caption Composite" scene with no 3D rendering of
+#  its own
+###
+
+COMPOSITE_SCENE = 'Caption Composite'
+
+
+def caption_objects(scene):
+	# what the caption render layers can see
+	visible = [FG_LAYER, BG_LAYER]
+	return [obj for obj in scene.objects if not obj.hide_render and any(obj.layers[i] for i in visible)]
+
+
+def material_state(mat):
+	state = [mat.name, tuple(mat.diffuse_color), mat.alpha, mat.use_shadeless]
+	if mat.node_tree:
+		for node in mat.node_tree.nodes:
+			state.extend(tuple(i.default_value) if hasattr(i.default_value, '__len__') else i.default_value
+				for i in node.inputs if hasattr(i, 'default_value') and not i.is_linked)
+			if node.type == 'RGB':
+				state.append(tuple(node.outputs['Color'].default_value))
+	return state
+
+
+# node settings that only change how the node editor looks
+NODE_UI = ('name', 'label', 'location', 'width', 'width_hidden', 'height', 'dimensions', 'select', 'hide',
+	'show_options', 'show_preview', 'show_texture', 'color', 'use_custom_color')
+
+
+def rna_state(struct, skip=()):
+	# every plain setting on struct, and the names of the datablocks it points at
+	state = []
+	for prop in struct.bl_rna.properties:
+		name = prop.identifier
+		if name == 'rna_type' or name in skip or prop.type == 'COLLECTION':
+			continue
+		value = getattr(struct, name, None)
+		if prop.type == 'POINTER':
+			if not isinstance(value, bpy.types.ID):
+				continue
+			value = value.name
+		elif prop.type == 'ENUM' and prop.is_enum_flag:
+			value = sorted(value)
+		elif getattr(prop, 'array_length', 0):
+			value = [list(v) if hasattr(v, '__len__') else v for v in value]
+		state.append((name, value))
+	return state
+
+
+def compositor_state(tree):
+	state = []
+	for node in sorted(tree.nodes, key=lambda node: node.name):
+		inputs = [(i.identifier, list(i.default_value) if hasattr(i.default_value, '__len__') else i.default_value)
+			for i in node.inputs if hasattr(i, 'default_value') and not i.is_linked]
+		state.append([node.bl_idname, node.name, rna_state(node, NODE_UI), inputs])
+	state.append(sorted((link.from_node.name, link.from_socket.identifier, link.to_node.name, link.to_socket.identifier) for link in tree.links))
+	return state
+
+
+def render_state(scene):
+	# the settings that reach the rendered overlay. Auto border picks its own per overlay
+	render = scene.render
+	skip = ('filepath', 'frame_path') + (BORDER_SETTINGS if scene.caption_auto_border else ())
+	state = [rna_state(render, skip), rna_state(render.image_settings)]
+	state += [rna_state(layer) for layer in render.layers]
+	if hasattr(scene, 'cycles'):
+		state.append(rna_state(scene.cycles))
+	return state
+
+
+def caption_fingerprint(scene):
+	# everything about the current frame that changes how the captions render
+	state = []
+	for obj in sorted(caption_objects(scene), key=lambda obj: obj.name):
+		item = [obj.name, obj.type, [round(v, 5) for row in obj.matrix_world for v in row]]
+		if obj.type == 'FONT':
+			text = obj.data
+			item += [text.body, text.size, text.bevel_depth, text.extrude, text.offset_x, text.offset_y,
+				text.font.name if text.font else None, text.align if hasattr(text, 'align') else text.align_x]
+		for slot in obj.material_slots:
+			if slot.material:
+				item.append(material_state(slot.material))
+		state.append(item)
+
+	camera = scene.camera
+	if camera:
+		state.append([[round(v, 5) for row in camera.matrix_world for v in row], camera.data.type, camera.data.ortho_scale, camera.data.lens])
+	state.append(render_state(scene))
+	state.append(compositor_state(scene.node_tree) if scene.node_tree else None)
+	return hashlib.sha1(json.dumps(state, default=str).encode()).hexdigest()
+
+
+def render_overlay(scene, path):
+	# just the captions, on a transparent background
+	comp = scene.node_tree
+	end = comp.nodes[COMPOSITE_NODE]
+	footage = end.inputs['Image'].links[0].from_socket if end.inputs['Image'].is_linked else None
+	render = scene.render
+	saved = (render.filepath, render.image_settings.file_format, render.image_settings.color_mode, render.alpha_mode)
+
+	comp.links.new(comp.nodes[TEXT_MIX_NODE].outputs['Image'], end.inputs['Image'])
+	render.filepath = path
+	render.image_settings.file_format = 'PNG'
+	render.image_settings.color_mode = 'RGBA'
+	render.alpha_mode = 'TRANSPARENT'
+	try:
+		bpy.ops.render.render(write_still=True, scene=scene.name)
+	finally:
+		render.filepath, render.image_settings.file_format, render.image_settings.color_mode, render.alpha_mode = saved
+		if footage:
+			comp.links.new(footage, end.inputs['Image'])
+
+
+def composite_scene(scene, overlay, frames):
+	# overlays over the footage, through the compositor alone
+	comp_scene = bpy.data.scenes.get(COMPOSITE_SCENE) or bpy.data.scenes.new(COMPOSITE_SCENE)
+	for attr in ('resolution_x', 'resolution_y', 'resolution_percentage', 'fps', 'fps_base', 'filepath'):
+		setattr(comp_scene.render, attr, getattr(scene.render, attr))
+	for attr in ('file_format', 'color_mode', 'color_depth', 'quality', 'compression'):
+		setattr(comp_scene.render.image_settings, attr, getattr(scene.render.image_settings, attr))
+	comp_scene.frame_start = scene.frame_start
+	comp_scene.frame_end = scene.frame_end
+	if not comp_scene.camera: # rendering wants one, though nothing here is looked through
+		camera = bpy.data.objects.new(COMPOSITE_SCENE, bpy.data.cameras.new(COMPOSITE_SCENE))
+		comp_scene.objects.link(camera)
+		comp_scene.camera = camera
+	comp_scene.use_nodes = True
+	comp = comp_scene.node_tree
+	comp.nodes.clear()
+
+	image = comp.nodes.new('CompositorNodeImage')
+	image.image = bpy.data.images.load(overlay, check_existing=True)
+	image.image.source = 'SEQUENCE'
+	image.frame_start = scene.frame_start
+	image.frame_offset = scene.frame_start - 1 # file numbers are frame numbers
+	image.frame_duration = frames
+	mixer = comp.nodes.new('CompositorNodeAlphaOver')
+	end = comp.nodes.new('CompositorNodeComposite')
+	image.location = (-140,200)
+	mixer.location = (200,400)
+	end.location = (400,400)
+
+	source = scene.node_tree.nodes.get(CLIP_NODE)
+	if source and source.clip:
+		clip = comp.nodes.new('CompositorNodeMovieClip')
+		clip.clip = source.clip
+		clip_size = comp.nodes.new('CompositorNodeScale')
+		clip_size.space = 'RENDER_SIZE'
+		clip.location = (-140,600)
+		clip_size.location = (50,500)
+		comp.links.new(clip.outputs['Image'], clip_size.inputs['Image'])
+		comp.links.new(clip_size.outputs['Image'], mixer.inputs[1])
+	comp.links.new(image.outputs['Image'], mixer.inputs[2])
+	comp.links.new(mixer.outputs['Image'], end.inputs['Image'])
+	return comp_scene
+
+
+def render_deduplicated(scene, cache, composite=True):
+	###
+	# Renders scene's frame range with each distinct caption overlay rendered
+	#  once into cache. Returns how many frames and how many overlays that was.
+	#  Without composite it stops at the overlays, e.g. for caption_composite.py
+	###
+	apply_caption_engine(scene)
+	cache = bpy.path.abspath(cache)
+	frames = os.path.join(cache, "frames")
+	os.makedirs(frames, exist_ok=True)
+	current = scene.frame_current
+	border = saved_border(scene)
+	seen = set()
+	try:
+		for frame in range(scene.frame_start, scene.frame_end+1):
+			scene.frame_set(frame)
+			fingerprint = caption_fingerprint(scene)
+			overlay = os.path.join(cache, fingerprint + ".png")
+			if not os.path.exists(overlay):
+				if scene.caption_auto_border: # every still render picks the border up afresh
+					apply_border(scene)
+				render_overlay(scene, overlay)
+			seen.add(fingerprint)
+
+			linked = os.path.join(frames, "overlay_{:04d}.png".format(frame))
+			if os.path.lexists(linked):
+				os.remove(linked)
+			try:
+				os.link(overlay, linked)
+			except OSError: # no hard links here
+				shutil.copyfile(overlay, linked)
+	finally:
+		restore_border(scene, border)
+		scene.frame_set(current)
+
+	count = scene.frame_end - scene.frame_start + 1
+	if not composite:
+		return count, len(seen)
+	comp_scene = composite_scene(scene, os.path.join(frames, "overlay_{:04d}.png".format(scene.frame_start)), count)
+	bpy.ops.render.render(animation=True, scene=comp_scene.name)
+	return count, len(seen)
+
+
+###
+# Auto border
+#  with the scene's "Auto Border" on, the Render button fits the render border
+#  to the captions before each overlay it renders: each caption object's
+#  bounding box projected through the camera, plus room for the shadow blur.
+#  Crop stays off, so frames keep their full size with only the caption pixels
+#  rendered. Only still renders pick up a new border, an animation render keeps
+#  the one it started with, so the scene's own border is put back afterwards
+###
+
+BORDER_PADDING = 4 # pixels kept clear around the captions
+BORDER_SETTINGS = ('use_border', 'use_crop_to_border', 'border_min_x', 'border_min_y', 'border_max_x', 'border_max_y')
+
+
+def caption_border(scene):
+	# (min x, min y, max x, max y) of the captions in the camera's view, snapped out to whole pixels
+	camera = scene.camera
+	if not camera:
+		return None
+	render = scene.render
+	width = render.resolution_x * render.resolution_percentage / 100.0
+	height = render.resolution_y * render.resolution_percentage / 100.0
+
+	xs, ys = [], []
+	for obj in caption_objects(scene):
+		if obj.type not in ('FONT','MESH','CURVE') or max(obj.dimensions) == 0: # nothing to see, e.g. between cues
+			continue
+		for corner in obj.bound_box:
+			co = world_to_camera_view(scene, camera, obj.matrix_world * Vector(corner))
+			xs.append(co.x)
+			ys.append(co.y)
+	if not xs:
+		return (0.0, 0.0, 1/width, 1/height)
+
+	padding = BORDER_PADDING
+	if scene.get('caption_single_pass'):
+		padding += SHADOW_GROW
+	switch = scene.node_tree.nodes.get(BLUR_SWITCH_NODE) if scene.node_tree else None
+	if switch and switch.check:
+		blur = switch.inputs['On'].links[0].from_node if switch.inputs['On'].is_linked else None
+		padding += max(blur.size_x, blur.size_y) if blur else 0
+
+	clamp = lambda v: min(max(v, 0.0), 1.0)
+	return (
+		clamp(math.floor(min(xs)*width - padding) / width),
+		clamp(math.floor(min(ys)*height - padding) / height),
+		clamp(math.ceil(max(xs)*width + padding) / width),
+		clamp(math.ceil(max(ys)*height + padding) / height),
+	)
+
+
+def apply_border(scene):
+	border = caption_border(scene)
+	render = scene.render
+	render.use_border = border is not None # no camera to fit it from, render everything
+	if border is None:
+		return
+	render.use_crop_to_border = False
+	render.border_min_x, render.border_min_y, render.border_max_x, render.border_max_y = border
+
+
+def saved_border(scene):
+	return [getattr(scene.render, attr) for attr in BORDER_SETTINGS]
+
+
+def restore_border(scene, saved):
+	for attr, value in zip(BORDER_SETTINGS, saved):
+		setattr(scene.render, attr, value)
+
+
+###
+# Flat captions
+#  caption materials are emission and transparency with nothing to bounce,
+#  so path tracing them buys nothing. When every caption material is that
+#  flat (and shadeless for Blender Internal), Blender Internal's scanline
+#  renderer draws them, still through the render layers and compositor.
+#  Anything shaded falls back to Cycles
+###
+
+FLAT_SHADER_NODES = {'RGB', 'EMISSION', 'BSDF_TRANSPARENT', 'MIX_SHADER', 'ADD_SHADER'}
+
+
+def flat_material(mat):
+	if not mat.use_shadeless or any(slot and slot.use for slot in mat.texture_slots):
+		return False
+	if not mat.use_nodes:
+		return True
+
+	tree = mat.node_tree
+	outputs = [node for node in tree.nodes if node.type == 'OUTPUT_MATERIAL']
+	if any(output.inputs['Volume'].is_linked or output.inputs['Displacement'].is_linked for output in outputs):
+		return False
+	upstream = [link.from_node for output in outputs for link in output.inputs['Surface'].links]
+	seen = set()
+	while upstream:
+		node = upstream.pop()
+		if node.name in seen:
+			continue
+		seen.add(node.name)
+		if node.type not in FLAT_SHADER_NODES:
+			return False
+		upstream.extend(link.from_node for socket in node.inputs for link in socket.links)
+
+	# Blender Internal's side of the tree has to be shadeless too
+	return all(node.material is None or node.material.use_shadeless
+		for node in tree.nodes if node.type in ('MATERIAL', 'MATERIAL_EXT'))
+
+
+def flat_captions(scene):
+	objects = [obj for obj in caption_objects(scene) if obj.type in ('FONT', 'MESH', 'CURVE')]
+	materials = [slot.material for obj in objects for slot in obj.material_slots]
+	if any(not obj.material_slots for obj in objects) or None in materials: # default material is shaded
+		return False
+	return all(flat_material(mat) for mat in set(materials))
+
+
+def apply_caption_engine(scene):
+	###
+	# Blender Internal for flat captions and Cycles otherwise, unless this
+	#  machine's calibration measured something else faster that can still
+	#  render them. Returns the engine
+	###
+	flat = flat_captions(scene)
+	calibrated = cached_calibration()
+	if calibrated and (flat or calibrated['config']['engine'] == 'CYCLES'):
+		apply_render_config(scene, calibrated['config'])
+	else:
+		scene.render.engine = 'BLENDER_RENDER' if flat else 'CYCLES'
+	return scene.render.engine
+
+
+###
+# Render calibration
+#  what renders captions fastest depends on the machine, so instead of trusting
+#  speedup_settings' guesses, the current frame's captions are rendered with a
+#  range of engines, devices, tile sizes and sample counts and compared to a
+#  high sample reference. The fastest setting close enough to the reference is
+#  applied, and kept per machine in the user config folder for Setup to reuse
+###
+
+CALIBRATION_FILE = 'caption_calibration.json'
+CALIBRATION_SAMPLES = (8, 16, 25, 50)
+CALIBRATION_TILES = (32, 64, 256)
+REFERENCE_SAMPLES = 256
+
+
+def machine_key():
+	return "{} {} {} cpus, blender {}".format(platform.node(), platform.machine(), os.cpu_count(), bpy.app.version_string)
+
+
+def calibration_path():
+	return os.path.join(bpy.utils.user_resource('CONFIG', create=True), CALIBRATION_FILE)
+
+
+def load_calibrations():
+	try:
+		with open(calibration_path()) as f:
+			return json.load(f)
+	except (IOError, ValueError):
+		return {}
+
+
+def cached_calibration():
+	return load_calibrations().get(machine_key())
+
+
+def gpu_available():
+	prefs = bpy.context.user_preferences
+	cycles = prefs.addons.get('cycles')
+	if cycles and hasattr(cycles.preferences, 'compute_device_type'):
+		return cycles.preferences.compute_device_type != 'NONE'
+	return getattr(prefs.system, 'compute_device_type', 'NONE') != 'NONE' # before 2.78
+
+
+def apply_render_config(scene, config):
+	scene.render.engine = config['engine']
+	scene.render.tile_x = scene.render.tile_y = config['tile']
+	if config['engine'] == 'CYCLES':
+		scene.cycles.device = config['device']
+		scene.cycles.samples = config['samples']
+
+
+def overlay_pixels(path):
+	# RGBA rows
+	image = bpy.data.images.load(path)
+	pixels = np.array(image.pixels[:], dtype=np.float32).reshape(-1,4)
+	bpy.data.images.remove(image)
+	return pixels
+
+
+def caption_error(pixels, expected):
+	# RMS over the pixels either render has captions on, however little of the frame that is
+	covered = (expected[:,3] > 0) | (pixels[:,3] > 0)
+	return float(np.sqrt(np.mean((pixels[covered] - expected[covered])**2)))
+
+
+def timed_overlay(scene, config, path):
+	apply_render_config(scene, config)
+	clock = time.perf_counter()
+	render_overlay(scene, path)
+	return time.perf_counter() - clock
+
+
+def calibrate(scene, max_error):
+	###
+	# Returns the chosen config (None if nothing was close enough) and every
+	#  (config, seconds, error) tried. Cycles sample counts go up from the
+	#  lowest until one passes, more can only be slower
+	###
+	render = scene.render
+	saved = {'engine': render.engine, 'tile': render.tile_x, 'device': scene.cycles.device, 'samples': scene.cycles.samples}
+	folder = tempfile.mkdtemp(prefix="caption_calibration")
+	trials = []
+	try:
+		reference = os.path.join(folder, "reference.png")
+		timed_overlay(scene, {'engine': 'CYCLES', 'device': 'CPU', 'tile': 32, 'samples': REFERENCE_SAMPLES}, reference)
+		expected = overlay_pixels(reference)
+		if not (expected[:,3] > 0).any():
+			raise ValueError("no captions on frame {} to calibrate with".format(scene.frame_current))
+
+		groups = []
+		if flat_captions(scene): # Blender Internal can't draw anything else like Cycles does
+			groups += [[{'engine': 'BLENDER_RENDER', 'tile': tile}] for tile in CALIBRATION_TILES]
+		for device in ['CPU'] + (['GPU'] if gpu_available() else []):
+			# first render on a device pays for loading it, so don't time that one
+			timed_overlay(scene, {'engine': 'CYCLES', 'device': device, 'tile': 64, 'samples': 1}, os.path.join(folder, "warmup.png"))
+			for tile in CALIBRATION_TILES:
+				groups.append([{'engine': 'CYCLES', 'device': device, 'tile': tile, 'samples': samples} for samples in CALIBRATION_SAMPLES])
+
+		for group in groups:
+			for config in group:
+				path = os.path.join(folder, "trial_{}.png".format(len(trials)))
+				seconds = timed_overlay(scene, config, path)
+				error = caption_error(overlay_pixels(path), expected)
+				trials.append((config, seconds, error))
+				if error <= max_error:
+					break
+	finally:
+		apply_render_config(scene, saved)
+		shutil.rmtree(folder, ignore_errors=True)
+
+	passed = [trial for trial in trials if trial[2] <= max_error]
+	if not passed:
+		return None, trials
+	config, seconds, error = min(passed, key=lambda trial: trial[1])
+	apply_render_config(scene, config)
+
+	calibrations = load_calibrations()
+	calibrations[machine_key()] = {'config': config, 'seconds': seconds, 'error': error, 'max_error': max_error, 'time': time.time()}
+	with open(calibration_path(), 'w') as f:
+		json.dump(calibrations, f, indent=1, sort_keys=True)
+	return config, trials
+
+
 class CaptionOperator(bpy.types.Operator):
 	bl_idname = "object.caption"
 	bl_label = "Caption"
 	bl_options = {'REGISTER', 'UNDO'}
 
+	single_pass = bpy.props.BoolProperty(
+		name="Single Pass",
+		default=False,
+		description="Render only the text, building its shadow in the compositor instead of from a second text object",
+	)
+
 	def execute(self, context):
 		render_settings()
 		speedup_settings()
 		setup_camera()
-		scene_layers()
-		compositor_setup()
+		scene_layers(self.single_pass)
+		compositor_setup(self.single_pass)
+		context.scene['caption_single_pass'] = self.single_pass
 
-		make_text()
+		make_text(shadow=not self.single_pass)
 
-		bpy.context.scene.render.engine = 'BLENDER_RENDER'
+		apply_caption_engine(context.scene)
 
 		return {'FINISHED'}	
 
+class CaptionSubtitles(bpy.types.Operator, ImportHelper):
+	bl_idname = "object.caption_subtitles"
+	bl_label = "Import Subtitles"
+	bl_description = "Caption every cue in an SRT or ASS subtitle file"
+	bl_options = {'REGISTER', 'UNDO'}
+
+	filter_glob = bpy.props.StringProperty(default="*.srt;*.ass;*.ssa", options={'HIDDEN'})
+	first_frame = bpy.props.IntProperty(
+		name="First Frame",
+		default=1,
+		description="Frame the start of the subtitle file lines up with"
+	)
+
+	def execute(self, context):
+		try:
+			cues, slots = load_subtitles(self.filepath, context.scene, self.first_frame)
+		except (IOError, ValueError, KeyError) as e:
+			self.report({'ERROR'}, "Couldn't read {}: {}".format(self.filepath, e))
+			return {'CANCELLED'}
+		self.report({'INFO'}, "{} cues over {} caption slots".format(cues, slots))
+		return {'FINISHED'}
+
+
+class CaptionRender(bpy.types.Operator):
+	bl_idname = "object.caption_render"
+	bl_label = "Render Captions"
+	bl_description = "Render the animation, rendering each distinct caption only once and reusing it for every frame it shows on"
+
+	cache = bpy.props.StringProperty(
+		name="Cache",
+		subtype='DIR_PATH',
+		default="//caption_cache/",
+		description="Where rendered caption overlays are kept"
+	)
+	composite = bpy.props.BoolProperty(
+		name="Composite",
+		default=True,
+		description="Composite the overlays over the footage too, instead of leaving just the overlays in the cache's frames folder"
+	)
+
+	@classmethod
+	def poll(cls, context):
+		tree = context.scene.node_tree
+		return tree is not None and COMPOSITE_NODE in tree.nodes and TEXT_MIX_NODE in tree.nodes
+
+	def execute(self, context):
+		frames, overlays = render_deduplicated(context.scene, self.cache, self.composite)
+		self.report({'INFO'}, "Rendered {} frames from {} caption overlays with {}".format(frames, overlays, context.scene.render.engine))
+		return {'FINISHED'}
+
+
+class CaptionCalibrate(bpy.types.Operator):
+	bl_idname = "object.caption_calibrate"
+	bl_label = "Calibrate Rendering"
+	bl_description = "Time this frame's captions with several render settings and keep the fastest that looks right, for this machine"
+
+	max_error = bpy.props.FloatProperty(
+		name="Max Error",
+		default=0.01,
+		min=0,
+		description="Furthest (RMS, over the caption pixels) a setting may be from a high sample render of the same frame"
+	)
+
+	@classmethod
+	def poll(cls, context):
+		tree = context.scene.node_tree
+		return tree is not None and COMPOSITE_NODE in tree.nodes and TEXT_MIX_NODE in tree.nodes
+
+	def execute(self, context):
+		try:
+			config, trials = calibrate(context.scene, self.max_error)
+		except ValueError as e:
+			self.report({'ERROR'}, str(e))
+			return {'CANCELLED'}
+		for trial, seconds, error in trials:
+			self.report({'INFO'}, "{}: {:.3f}s, error {:.4f}".format(json.dumps(trial, sort_keys=True), seconds, error))
+		if not config:
+			self.report({'WARNING'}, "No setting came within {} of the reference".format(self.max_error))
+			return {'CANCELLED'}
+		self.report({'INFO'}, "Rendering with {}".format(", ".join("{} {}".format(k, v) for k, v in sorted(config.items()))))
+		return {'FINISHED'}
+
+
 class CaptionPanel(bpy.types.Panel):
 	bl_label = "Caption"
 	bl_idname = "OBJECT_PT_caption"
@@ -330,15 +1074,39 @@ class CaptionPanel(bpy.types.Panel):
 		col = layout.column(align=True)
 		row = col.row(align=True)
 		row.operator("object.caption", text = "Setup")
+		row = col.row(align=True)
+		row.operator("object.caption_subtitles", text = "Subtitles")
+		row = col.row(align=True)
+		row.operator("object.caption_render", text = "Render", icon='RENDER_ANIMATION')
+		row = col.row(align=True)
+		row.prop(context.scene, 'caption_auto_border')
+		row = col.row(align=True)
+		row.operator("object.caption_calibrate", text = "Calibrate")
 
 
 
 def register():
 	bpy.utils.register_class(CaptionPanel)
 	bpy.utils.register_class(CaptionOperator)
+	bpy.utils.register_class(CaptionSubtitles)
+	bpy.utils.register_class(CaptionRender)
+	bpy.utils.register_class(CaptionCalibrate)
+	bpy.types.Scene.caption_auto_border = bpy.props.BoolProperty(
+		name="Auto Border",
+		default=False,
+		description="Have Render only render the part of each caption overlay the captions cover"
+	)
+	if show_cues not in bpy.app.handlers.frame_change_pre:
+		bpy.app.handlers.frame_change_pre.append(show_cues)
 def unregister():
 	bpy.utils.unregister_class(CaptionPanel)
 	bpy.utils.unregister_class(CaptionOperator)
+	bpy.utils.unregister_class(CaptionSubtitles)
+	bpy.utils.unregister_class(CaptionRender)
+	bpy.utils.unregister_class(CaptionCalibrate)
+	if show_cues in bpy.app.handlers.frame_change_pre:
+		bpy.app.handlers.frame_change_pre.remove(show_cues)
+	del bpy.types.Scene.caption_auto_border
 
 if __name__ == "__main__":
 	register()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""
+caption_composite.py -- composite rendered caption overlays over footage, outside blender
+
+Copyright (c) 2015 Dan Panzarella <alsoelp@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+"""
+	Run from a regular python with numpy, after a caption Render with
+	"Composite" off has left the overlays in caption_cache/frames:
+
+		python caption_composite.py footage.mp4 caption_cache/frames/overlay_%04d.png --start 1 --out render/frame_%04d.png
+
+	ffmpeg decodes the footage and the overlays and encodes the result, so
+	--out can be an image sequence or a movie. Frames go through in chunks of
+	--chunk, split across --workers threads: the footage is scaled to the
+	overlay size, an optional drop shadow is made from the overlay's alpha
+	(--shadow-offset, --shadow-blur), and the overlay goes over the top.
+	Only a couple of chunks are ever in memory.
+"""
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+BLUR_PASSES = 3 # box blurs in a row, close enough to gaussian
+
+
+def video_size(path, start=None):
+	command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=width,height', '-of', 'json']
+	if start is not None:
+		command += ['-start_number', str(start)]
+	stream = json.loads(subprocess.check_output(command + [path]).decode())['streams'][0]
+	return stream['width'], stream['height']
+
+
+def decoder(path, pix_fmt, start=None):
+	command = ['ffmpeg', '-v', 'error']
+	if start is not None:
+		command += ['-start_number', str(start)]
+	command += ['-i', path, '-f', 'rawvideo', '-pix_fmt', pix_fmt, '-']
+	return subprocess.Popen(command, stdout=subprocess.PIPE)
+
+
+def encoder(path, size, fps, start):
+	command = ['ffmpeg', '-y', '-v', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+		'-s', '{}x{}'.format(*size), '-framerate', str(fps), '-i', '-']
+	if '%' in path: # image sequence, numbered like the overlays
+		command += ['-start_number', str(start)]
+	else:
+		command += ['-pix_fmt', 'yuv420p']
+	return subprocess.Popen(command + [path], stdin=subprocess.PIPE)
+
+
+def read_frames(pipe, shape, count):
+	size = int(np.prod(shape))
+	frames = []
+	for i in range(count):
+		data = pipe.stdout.read(size)
+		if len(data) < size:
+			break
+		frames.append(np.frombuffer(data, dtype=np.uint8).reshape(shape))
+	return frames
+
+
+class Scaler(object):
+	"""Bilinear resize to a fixed size, with the sample positions worked out once"""
+
+	def __init__(self, source, target):
+		(sw, sh), (tw, th) = source, target
+		self.identity = source == target
+		self.y0, self.y1, self.wy = self.axis(sh, th)
+		self.x0, self.x1, self.wx = self.axis(sw, tw)
+		self.wy = self.wy[:, None, None]
+		self.wx = self.wx[None, :, None]
+
+	@staticmethod
+	def axis(source, target):
+		# pixel centres of the target, in source pixels
+		position = np.clip((np.arange(target, dtype=np.float32) + 0.5) * source / target - 0.5, 0, source - 1)
+		low = np.floor(position).astype(np.intp)
+		high = np.minimum(low + 1, source - 1)
+		return low, high, position - low
+
+	def __call__(self, image):
+		if self.identity:
+			return image.astype(np.float32)
+		top = image[self.y0].astype(np.float32)
+		bottom = image[self.y1].astype(np.float32)
+		rows = top + (bottom - top) * self.wy
+		left = rows[:, self.x0]
+		return left + (rows[:, self.x1] - left) * self.wx
+
+
+def box_blur(image, radius, axis):
+	# running sums along axis, edges held
+	pad = [(0, 0)] * image.ndim
+	pad[axis] = (radius + 1, radius)
+	sums = np.cumsum(np.pad(image, pad, mode='edge'), axis=axis, dtype=np.float32)
+	width = image.shape[axis]
+	upper = np.take(sums, np.arange(2*radius + 1, 2*radius + 1 + width), axis=axis)
+	lower = np.take(sums, np.arange(width), axis=axis)
+	return (upper - lower) / (2*radius + 1)
+
+
+def drop_shadow(alpha, offset, blur):
+	###
+	# Black shadow from the text's alpha, moved by offset (x right, y down)
+	#  and softened by blur pixels
+	###
+	dx, dy = offset
+	shadow = np.zeros_like(alpha)
+	h, w = alpha.shape
+	if abs(dx) >= w or abs(dy) >= h: # pushed clean off the frame
+		return shadow
+	shadow[max(dy, 0):h + min(dy, 0), max(dx, 0):w + min(dx, 0)] = alpha[max(-dy, 0):h - max(dy, 0), max(-dx, 0):w - max(dx, 0)]
+	if blur > 0:
+		radius = max(1, blur // BLUR_PASSES) # the passes spread it out between them
+		for i in range(BLUR_PASSES):
+			shadow = box_blur(box_blur(shadow, radius, 0), radius, 1)
+	return shadow
+
+
+def composite(footage, overlay, scale, shadow_offset, shadow_blur):
+	# footage rgb and overlay rgba (straight alpha) as uint8, out comes rgb uint8
+	frame = scale(footage)
+	alpha = overlay[..., 3].astype(np.float32) / 255
+	if shadow_offset != (0, 0) or shadow_blur:
+		frame *= (1 - drop_shadow(alpha, shadow_offset, shadow_blur))[..., None]
+	frame += (overlay[..., :3] - frame) * alpha[..., None]
+	return np.clip(frame + 0.5, 0, 255).astype(np.uint8)
+
+
+def pixels(text):
+	value = int(text)
+	if value < 0:
+		raise argparse.ArgumentTypeError("can't be negative")
+	return value
+
+
+def pair(text):
+	x, y = text.split(',')
+	return int(x), int(y)
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Composite caption overlays over footage with numpy, outside blender")
+	parser.add_argument('footage', help="movie or image sequence (ffmpeg pattern) to caption")
+	parser.add_argument('overlays', help="ffmpeg pattern of the RGBA caption overlays, e.g. caption_cache/frames/overlay_%%04d.png")
+	parser.add_argument('--start', type=int, default=1, help="number of the first overlay")
+	parser.add_argument('--out', default='composite_%04d.png', help="image sequence pattern or movie to write")
+	parser.add_argument('--fps', type=float, default=24, help="frame rate of --out")
+	parser.add_argument('--shadow-offset', type=pair, default=(0, 0), help="x,y pixels to drop a shadow from the overlay alpha by (y down)")
+	parser.add_argument('--shadow-blur', type=pixels, default=0, help="pixels to soften the drop shadow by")
+	parser.add_argument('--chunk', type=int, default=16, help="frames read and composited at a time")
+	parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help="compositing threads")
+	args = parser.parse_args(argv)
+
+	footage_size = video_size(args.footage)
+	size = video_size(args.overlays, args.start)
+	width, height = size
+	scale = Scaler(footage_size, size)
+
+	footage = decoder(args.footage, 'rgb24')
+	overlays = decoder(args.overlays, 'rgba', args.start)
+	out = encoder(args.out, size, args.fps, args.start)
+
+	frames = 0
+	clock = time.perf_counter()
+	# numpy lets go of the GIL for the heavy lifting, so threads share the cores
+	with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as pool:
+		pending = None
+		while True:
+			overlay_chunk = read_frames(overlays, (height, width, 4), args.chunk)
+			footage_chunk = read_frames(footage, (footage_size[1], footage_size[0], 3), len(overlay_chunk))
+			count = min(len(overlay_chunk), len(footage_chunk))
+			# the next chunk is read while this one composites, and written once it's done
+			if pending:
+				for frame in pending:
+					out.stdin.write(frame.result().tobytes())
+			if not count:
+				break
+			pending = [pool.submit(composite, footage_chunk[i], overlay_chunk[i], scale, args.shadow_offset, args.shadow_blur) for i in range(count)]
+			frames += count
+
+	out.stdin.close()
+	for process in (footage, overlays):
+		process.stdout.close()
+		process.kill()
+		process.wait()
+	if out.wait() != 0:
+		sys.exit("ffmpeg couldn't write " + args.out)
+	seconds = time.perf_counter() - clock
+	print("{} frames in {:.1f}s ({:.1f} fps)".format(frames, seconds, frames / max(seconds, 1e-9)))
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+"""
+caption_farm.py -- render a caption scene's frames with several local blenders at once
+
+Copyright (c) 2015 Dan Panzarella <alsoelp@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+"""
+	Run from a regular python, on a .blend set up with caption.py:
+
+		python caption_farm.py captions.blend --blender /path/to/blender --workers 8 --out render
+
+	The frame range is split into chunks, each rendered by a background blender
+	with caption.py loaded (for subtitle cues). Chunks start
+	small and grow to about --chunk-seconds of work each once per-frame times
+	are known. Frames land in order as render/frame_0001.png etc; chunks with
+	missing frames are tried again. --movie joins the frames with ffmpeg.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+INFO_MARKER = "CAPTION_FARM_SCENE "
+FIRST_CHUNK = 2 # frames per chunk until there are timings to go on
+
+
+def scene_info(blender, blend, scene):
+	# ask blender for the scene's frame range and frame rate
+	expr = ("import bpy; s = bpy.data.scenes[{!r}] if {!r} else bpy.context.scene; "
+		"print({!r}, s.frame_start, s.frame_end, s.render.fps / s.render.fps_base)").format(scene or "", scene or "", INFO_MARKER)
+	output = subprocess.check_output([blender, '-b', blend, '--python-expr', expr], stderr=subprocess.STDOUT).decode(errors='replace')
+	for line in output.splitlines():
+		if line.startswith(INFO_MARKER):
+			start, end, fps = line[len(INFO_MARKER):].split()
+			return int(start), int(end), fps
+	raise RuntimeError("couldn't read the scene's frame range:\n" + output[-2000:])
+
+
+def frame_path(out, frame):
+	return os.path.join(out, "frame_{:04d}.png".format(frame))
+
+
+class Scheduler(object):
+	"""Hands out frame chunks sized from how long frames have taken so far"""
+
+	def __init__(self, frames, workers, chunk_seconds, retries):
+		self.pending = list(frames)
+		self.workers = workers
+		self.chunk_seconds = chunk_seconds
+		self.retries = retries
+		self.failures = {}
+		self.failed = []
+		self.seconds = 0.0
+		self.rendered = 0
+		self.lock = threading.Lock()
+
+	def chunk_size(self):
+		if not self.rendered:
+			return FIRST_CHUNK
+		size = int(self.chunk_seconds / (self.seconds / self.rendered))
+		# leave enough to keep every worker busy to the end
+		return max(1, min(size, -(-len(self.pending) // self.workers)))
+
+	def next(self):
+		with self.lock:
+			if not self.pending:
+				return None
+			size = self.chunk_size()
+			chunk = [self.pending[0]]
+			for frame in self.pending[1:]:
+				if len(chunk) == size or frame != chunk[-1] + 1: # one blender call renders one run of frames
+					break
+				chunk.append(frame)
+			del self.pending[:len(chunk)]
+			return chunk
+
+	def done(self, chunk, missing, seconds):
+		with self.lock:
+			rendered = len(chunk) - len(missing)
+			if rendered:
+				self.seconds += seconds
+				self.rendered += rendered
+			for frame in missing:
+				self.failures[frame] = self.failures.get(frame, 0) + 1
+				if self.failures[frame] > self.retries:
+					self.failed.append(frame)
+				else:
+					self.pending.append(frame)
+			self.pending.sort()
+
+
+def render_chunk(args, out, chunk):
+	command = [args.blender, '-b', args.blend]
+	if args.scene:
+		command += ['-S', args.scene]
+	command += [
+		'-t', str(args.threads),
+		'-P', os.path.join(HERE, 'caption.py'), # registers the subtitle handler
+		'-o', os.path.join(out, 'frame_####'),
+		'-F', 'PNG',
+		'-x', '1',
+		'-s', str(chunk[0]), '-e', str(chunk[-1]),
+		'-a',
+	]
+	log = os.path.join(out, 'logs', 'frames_{:04d}-{:04d}.log'.format(chunk[0], chunk[-1]))
+	with open(log, 'w') as f:
+		subprocess.call(command, stdout=f, stderr=subprocess.STDOUT)
+
+
+def work(args, out, scheduler):
+	while True:
+		chunk = scheduler.next()
+		if chunk is None:
+			return
+		for frame in chunk: # don't count stale frames from an earlier run
+			if os.path.exists(frame_path(out, frame)):
+				os.remove(frame_path(out, frame))
+		start = time.perf_counter()
+		render_chunk(args, out, chunk)
+		seconds = time.perf_counter() - start
+		missing = [frame for frame in chunk if not os.path.exists(frame_path(out, frame))]
+		scheduler.done(chunk, missing, seconds)
+		print("frames {}-{}: {:.1f}s{}".format(chunk[0], chunk[-1], seconds,
+			", {} missing".format(len(missing)) if missing else ""))
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Render a caption scene with several local blender processes")
+	parser.add_argument('blend', help="caption scene .blend")
+	parser.add_argument('--blender', default='blender', help="blender binary")
+	parser.add_argument('--scene', help="scene to render (default: the active one)")
+	parser.add_argument('--start', type=int, help="first frame (default: the scene's)")
+	parser.add_argument('--end', type=int, help="last frame (default: the scene's)")
+	parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help="blender processes at once")
+	parser.add_argument('--threads', type=int, default=0, help="render threads per blender (default: cores / workers)")
+	parser.add_argument('--chunk-seconds', type=float, default=30.0, help="about how long each chunk should take")
+	parser.add_argument('--retries', type=int, default=2, help="times to try a frame again after it fails")
+	parser.add_argument('--out', default='render', help="folder for the rendered frames")
+	parser.add_argument('--movie', help="also join the frames into this movie with ffmpeg")
+	args = parser.parse_args(argv)
+
+	args.blend = os.path.abspath(args.blend)
+	args.threads = args.threads or max(1, multiprocessing.cpu_count() // args.workers)
+	out = os.path.abspath(args.out)
+	os.makedirs(os.path.join(out, 'logs'), exist_ok=True)
+
+	scene_start, scene_end, fps = scene_info(args.blender, args.blend, args.scene)
+	start = scene_start if args.start is None else args.start
+	end = scene_end if args.end is None else args.end
+
+	scheduler = Scheduler(range(start, end+1), args.workers, args.chunk_seconds, args.retries)
+	clock = time.perf_counter()
+	workers = [threading.Thread(target=work, args=(args, out, scheduler)) for i in range(args.workers)]
+	for worker in workers:
+		worker.start()
+	for worker in workers:
+		worker.join()
+	wall = time.perf_counter() - clock
+
+	report = {
+		'frames': [start, end],
+		'workers': args.workers,
+		'threads': args.threads,
+		'seconds': wall,
+		'seconds_per_frame': scheduler.seconds / scheduler.rendered if scheduler.rendered else None,
+		'failed': sorted(scheduler.failed),
+	}
+	with open(os.path.join(out, 'farm.json'), 'w') as f:
+		json.dump(report, f, indent=1, sort_keys=True)
+	print("{} frames in {:.1f}s".format(end - start + 1 - len(scheduler.failed), wall))
+
+	if scheduler.failed:
+		print("failed frames: " + " ".join(str(frame) for frame in sorted(scheduler.failed)))
+		sys.exit(1)
+
+	if args.movie:
+		if not shutil.which('ffmpeg'):
+			sys.exit("ffmpeg not found, frames are in " + out)
+		subprocess.check_call(['ffmpeg', '-y', '-framerate', fps, '-start_number', str(start),
+			'-i', os.path.join(out, 'frame_%04d.png'), '-pix_fmt', 'yuv420p', args.movie])
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
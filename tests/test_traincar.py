@@ -0,0 +1,123 @@
+"""
+	traincar.py checks, run inside blender:
+
+		blender -b --factory-startup --python tests/test_traincar.py
+
+	Outside of blender (no bpy) they are skipped.
+"""
+
+import os
+import sys
+import unittest
+
+try:
+	import bpy
+except ImportError:
+	bpy = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+if bpy:
+	import traincar
+
+
+def empty_scene():
+	scene = bpy.context.scene
+	for obj in list(scene.objects):
+		scene.objects.unlink(obj)
+	if not scene.rigidbody_world:
+		bpy.ops.rigidbody.world_add()
+	return scene
+
+
+def rigid_cube(name, location, kind='ACTIVE'):
+	bpy.ops.mesh.primitive_cube_add(location=location)
+	obj = bpy.context.active_object
+	obj.name = name
+	bpy.ops.rigidbody.object_add(type=kind)
+	return obj
+
+
+def constraint_empty(name, location, kind, object1, object2):
+	bpy.ops.object.empty_add(location=location)
+	obj = bpy.context.active_object
+	obj.name = name
+	bpy.ops.rigidbody.constraint_add(type=kind)
+	obj.rigid_body_constraint.object1 = object1
+	obj.rigid_body_constraint.object2 = object2
+	return obj
+
+
+@unittest.skipIf(bpy is None, "needs blender")
+class ConstraintMapTest(unittest.TestCase):
+
+	def setUp(self):
+		self.scene = empty_scene()
+		self.ground = rigid_cube("Ground", (0,0,-2), 'PASSIVE')
+		engine = rigid_cube("Engine", (0,3,1))
+		self.car = rigid_cube("Car", (0,0,1))
+		# coupled to the car ahead, which sits outside the rig, and anchored to the ground
+		self.hinge = constraint_empty("Hinge", (0,1.5,1), 'HINGE', engine, self.car)
+		self.anchor = constraint_empty("Anchor", (0,0,0), 'GENERIC_SPRING', self.ground, self.car)
+		self.rig = [self.car, self.hinge, self.anchor]
+
+	def test_map(self):
+		self.assertEqual(traincar.constraint_map(self.rig), [(1, 'FRONT', 'CAR'), (2, None, 'CAR')])
+
+	def test_matches_per_copy_rewiring(self):
+		links = traincar.constraint_map(self.rig)
+		rig = self.rig
+		for i in range(3):
+			current_car, new_car, rig = traincar.duplicate((0,-3,0), rig, self.scene, links=links)
+			hinge, anchor = rig[1].rigid_body_constraint, rig[2].rigid_body_constraint
+			# what the per-copy rewiring made of couplings
+			self.assertEqual((hinge.object1, hinge.object2), (current_car, new_car))
+			# the anchor stays on the ground, holding the new car
+			self.assertEqual((anchor.object1, anchor.object2), (self.ground, new_car))
+
+	def test_anchors(self):
+		# passive or no rigid body at all holds the car where it is, whichever end it's on
+		post = bpy.data.objects.new("Post", None)
+		self.scene.objects.link(post)
+		self.anchor.rigid_body_constraint.object1 = self.car
+		self.anchor.rigid_body_constraint.object2 = post
+		self.assertEqual(traincar.constraint_map(self.rig)[1], (2, 'CAR', None))
+		# an active body outside the rig is the car ahead, not an anchor
+		self.anchor.rigid_body_constraint.object1 = rigid_cube("Loose", (0,6,1))
+		self.anchor.rigid_body_constraint.object2 = self.car
+		self.assertEqual(traincar.constraint_map(self.rig)[1], (2, 'FRONT', 'CAR'))
+
+
+@unittest.skipIf(bpy is None, "needs blender")
+class WriteKeyframesTest(unittest.TestCase):
+
+	def setUp(self):
+		self.action = bpy.data.actions.new("WriteKeyframesTest")
+		self.curve = self.action.fcurves.new('rigid_body.kinematic')
+
+	def tearDown(self):
+		bpy.data.actions.remove(self.action)
+
+	def test_later_key_keeps_interpolation(self):
+		# end_frame+1 == start_frame: the derail key lands on the CONSTANT start key
+		traincar.write_keyframes(self.curve, [(1.0, 1, 'CONSTANT'), (1.0, 0, None)])
+		points = self.curve.keyframe_points
+		self.assertEqual(len(points), 1)
+		self.assertEqual(points[0].co[1], 0)
+		self.assertEqual(points[0].interpolation, 'CONSTANT')
+
+	def test_later_interpolation_wins(self):
+		traincar.write_keyframes(self.curve, [(1.0, 1, 'CONSTANT'), (1.0, 0, 'LINEAR')])
+		self.assertEqual(self.curve.keyframe_points[0].interpolation, 'LINEAR')
+
+	def test_batch_matches_repeated_inserts(self):
+		keys = traincar.KeyframeBatch()
+		keys.insert(self.curve, 1, 1, 'CONSTANT')
+		keys.insert(self.curve, 1, 0)
+		keys.write()
+		self.assertEqual(self.curve.keyframe_points[0].interpolation, 'CONSTANT')
+
+
+if __name__ == "__main__":
+	unittest.main(argv=[sys.argv[0]])
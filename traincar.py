@@ -26,6 +26,22 @@ THE SOFTWARE.
 #GOOD_ICONS = 'PLUS','ZOOMIN','AUTO','LINKED','NEW','CONSTRAINT','MOD_ARRAY'
 
 import bpy
+import argparse
+import bmesh
+import cProfile
+import contextlib
+import csv
+import itertools
+import json
+import math
+import os
+import sys
+import time
+import numpy as np
+from bpy_extras.io_utils import ExportHelper, ImportHelper
+from mathutils import Matrix, Vector
+from mathutils.bvhtree import BVHTree
+from mathutils.kdtree import KDTree
 
 
 class TrainCarAdd(bpy.types.Operator):
@@ -51,6 +67,31 @@ class TrainCarAdd(bpy.types.Operator):
 		unit='VELOCITY',
 		description="Initial Train Velocity"
 	)
+	track = bpy.props.StringProperty(
+		name="Track",
+		description="Curve for the train to follow, at the speed of Velocity with cars the length of Spacing apart"
+	)
+
+	shared = bpy.props.BoolProperty(
+		name="Shared Action",
+		default=False,
+		description="Move every car with one shared action, instead of giving each car its own copy",
+	)
+
+	proxy = bpy.props.BoolProperty(
+		name="Proxy Physics",
+		default=False,
+		description="Simulate a simple stand-in shape per car, showing the real car as a group instance on it",
+	)
+	proxy_shape = bpy.props.EnumProperty(
+		items=(
+			('BOX',"Box","Simulate the car's bounding box",'MESH_CUBE',1),
+			('CONVEX_HULL',"Convex Hull","Simulate the car's convex hull",'MESH_ICOSPHERE',2),
+		),
+		name='Proxy Shape',
+		default='BOX',
+		description="Shape simulated in place of each car",
+	)
 
 	derail = bpy.props.BoolProperty(
 		name="Derail",
@@ -68,6 +109,7 @@ class TrainCarAdd(bpy.types.Operator):
 			('OBJ',"Object","Train derails at an object",'OBJECT_DATA',1),
 			('LOC',"Location","Train derails at manually entered location",'AXIS_SIDE',2),
 			('FRAME',"Frame","Train derails at specific frame",'TIME',3),
+			('GROUP',"Group","Train derails at whichever object in a group it reaches first",'GROUP',4),
 		),
 		name='Derail At',
 		description="What type of thing triggers a derailment",
@@ -77,6 +119,10 @@ class TrainCarAdd(bpy.types.Operator):
 		name="Object",
 		description="Derail train at this object's location"
 	)
+	derail_group = bpy.props.StringProperty(
+		name="Group",
+		description="Derail train at the first of this group's objects it reaches"
+	)
 	derail_obj_type = bpy.props.EnumProperty(
 		items=(
 			('BOUND',"Bounds","Train derails as it is inside object's bounds",'MOD_SUBSURF',1),
@@ -93,6 +139,14 @@ class TrainCarAdd(bpy.types.Operator):
 		description="Global coordinates to derailment"
 	)
 
+	derail_tolerance = bpy.props.FloatProperty(
+		name="Tolerance",
+		default=2.0,
+		min=0,
+		unit='LENGTH',
+		description="How close a car has to get to the derail point, on every axis"
+	)
+
 	derail_frame = bpy.props.IntProperty(
 		name='Frame',
 		default=10,
@@ -109,6 +163,22 @@ class TrainCarAdd(bpy.types.Operator):
 		default=False,
 		description="Live Update",
 	)
+	incremental = bpy.props.BoolProperty(
+		name="Incremental",
+		default=False,
+		description="Update the train this car already belongs to, only redoing what changed (from the next time Add cars is used on it, a new train's first tweaks rebuild it)",
+	)
+
+	profile = bpy.props.BoolProperty(
+		name="Profile",
+		default=False,
+		description="Time each step of making the train, shown in the Traincar panel (also on with TRAINCAR_PROFILE set)",
+	)
+	profile_trace = bpy.props.StringProperty(
+		name="Trace",
+		subtype='FILE_PATH',
+		description="Also write the profile here: cProfile stats for a .prof file, JSON otherwise",
+	)
 
 
 	@classmethod
@@ -116,23 +186,57 @@ class TrainCarAdd(bpy.types.Operator):
 		return context.active_object is not None and context.active_object.rigid_body is not None
 
 	def execute(self, context):
+		track = context.scene.objects.get(self.track) if self.track else None
+		if track and track.type != 'CURVE':
+			self.report({'ERROR'}, "Track {} is not a curve".format(self.track))
+			return {'CANCELLED'}
 		if self.go:
-			do_traincars(
-				spacing=self.spacing,
-				amount=self.n,
-				velo=self.velo,
-				derail=self.derail,
-				collectively=self.derail_collective,
-				derail_type=self.derail_at,
-				derail_val = self.derail_obj if self.derail_at == 'OBJ' else self.derail_loc if self.derail_at == 'LOC' else (self.derail_frame,self.derail_frame_spacing)
-			)
+			profiling, trace = profile_trace(self.profile, bpy.path.abspath(self.profile_trace) if self.profile_trace else "")
+			profiler = Profiler(trace) if profiling else None
+			with profiler or contextlib.ExitStack():
+				do_traincars(
+					spacing=self.spacing,
+					amount=self.n,
+					velo=self.velo,
+					derail=self.derail,
+					collectively=self.derail_collective,
+					derail_type=derail_type(self.derail_at, self.derail_obj_type),
+					derail_val=derail_val(self.derail_at, self.derail_obj, self.derail_group, self.derail_loc, self.derail_frame, self.derail_frame_spacing),
+					tolerance=self.derail_tolerance,
+					incremental=self.incremental,
+					shared=self.shared,
+					proxy=self.proxy_shape if self.proxy else None,
+					track=track.name if track else None
+				)
+			if profiler:
+				profile_summary.clear()
+				profile_summary.update(profiler.report())
 		return {'FINISHED'}
 
+	def invoke(self, context, event):
+		###
+		# pick up where the train this car belongs to left off. Tweaks in the redo
+		#  panel undo the last run before calling execute again, so they only get
+		#  to update in place when the train was already there before this run.
+		#  A train this run made is gone again by then, and gets made from scratch
+		###
+		state = load_train(train_engine(context.active_object)) if self.incremental else None
+		if state:
+			self.n = len(state['rigs']) - 1
+			self.spacing = state['spacing']
+			self.velo = state['velo']
+			self.derail = state['derail']
+			self.shared = state.get('shared', False)
+			self.track = state.get('track') or ""
+		return self.execute(context)
+
 	def draw(self,context):
 		layout = self.layout
 
 		col = layout.column(align=True)
-		col.prop(self,'go')
+		row = col.row(align=True)
+		row.prop(self,'go')
+		row.prop(self,'incremental')
 
 		col = layout.column(align=True)
 		row = col.row(align=True)
@@ -145,6 +249,17 @@ class TrainCarAdd(bpy.types.Operator):
 		#velocity
 		col = layout.column(align=True)
 		col.prop(self,'velo')
+		col.prop_search(self, 'track', context.scene, 'objects')
+		row = col.row(align=True)
+		row.enabled = not self.track
+		row.prop(self,'shared')
+
+		col = layout.column(align=True)
+		row = col.row(align=True)
+		row.prop(self,'proxy')
+		sub = row.row(align=True)
+		sub.enabled = self.proxy
+		sub.prop(self,'proxy_shape', text="")
 
 		col = layout.column(align=True)
 		row = col.row(align=True)
@@ -159,13 +274,18 @@ class TrainCarAdd(bpy.types.Operator):
 
 		col = layout.column(align=True)
 		col.enabled = self.derail
-		if self.derail_at == 'OBJ':
-			col.prop_search(self, 'derail_obj', context.scene, 'objects')
+		if self.derail_at in ('OBJ','GROUP'):
+			if self.derail_at == 'OBJ':
+				col.prop_search(self, 'derail_obj', context.scene, 'objects')
+			else:
+				col.prop_search(self, 'derail_group', bpy.data, 'groups')
 			row = col.row(align=True)
-			row.enabled = False
 			row.prop(self,'derail_obj_type')
+			if self.derail_obj_type == 'LOC':
+				col.prop(self,'derail_tolerance')
 		elif self.derail_at == 'LOC':
 			col.prop(self,'derail_loc')
+			col.prop(self,'derail_tolerance')
 		else:
 			row = col.row(align=True)
 			row.prop(self,'derail_frame')
@@ -173,6 +293,114 @@ class TrainCarAdd(bpy.types.Operator):
 			row.enabled = not self.derail_collective
 			row.prop(self,'derail_frame_spacing')
 
+		col = layout.column(align=True)
+		row = col.row(align=True)
+		row.prop(self,'profile')
+		sub = row.row(align=True)
+		sub.enabled = self.profile
+		sub.prop(self,'profile_trace', text="")
+
+
+class TrainCarTune(bpy.types.Operator):
+	bl_idname = "object.traincar_tune"
+	bl_label = "Tune Rigid Body World"
+	bl_description = "Trial bake the active car's train at several substep and iteration settings, keeping the cheapest stable one"
+	bl_options = {'REGISTER', 'UNDO'}
+
+	trial_frames = bpy.props.IntProperty(
+		name="Trial Frames",
+		default=60,
+		min=1,
+		description="How many frames past the first derail each trial bakes"
+	)
+	max_separation = bpy.props.FloatProperty(
+		name="Max Separation",
+		default=0.05,
+		min=0,
+		unit='LENGTH',
+		description="Furthest a constraint's two bodies may drift apart at its pivot and still count as stable"
+	)
+	speed_factor = bpy.props.FloatProperty(
+		name="Speed Limit",
+		default=5.0,
+		min=1.0,
+		description="Fastest a car may move in a frame, as a multiple of the train's speed, before the simulation counts as blown up"
+	)
+
+	@classmethod
+	def poll(cls, context):
+		return context.scene.rigidbody_world is not None and context.active_object is not None and has_train(context.active_object)
+
+	def execute(self, context):
+		scene = context.scene
+		state = load_train(train_engine(context.active_object))
+		rigs = [[scene.objects.get(name) for name in names] for names in state['rigs']]
+		if any(None in rig for rig in rigs):
+			self.report({'ERROR'}, "Some of this train's cars are gone, add cars again first")
+			return {'CANCELLED'}
+
+		max_speed = self.speed_factor * max(Vector(state['velo']).length, 0.1)
+		best, trials = tune_world(scene, rigs, self.trial_frames, self.max_separation, max_speed)
+		for steps, iterations, seconds, separation, speed in trials:
+			self.report({'INFO'}, "{} steps {} iterations: {:.2f}s, separation {:.3f}, speed {:.3f}".format(steps, iterations, seconds, separation, speed))
+		if not best:
+			self.report({'WARNING'}, "No stable setting found, rigid body world left as it was")
+			return {'CANCELLED'}
+		self.report({'INFO'}, "Rigid body world set to {} steps per second, {} solver iterations".format(*best))
+		return {'FINISHED'}
+
+
+class TrainCarExport(bpy.types.Operator, ExportHelper):
+	bl_idname = "object.traincar_export"
+	bl_label = "Export Train"
+	bl_description = "Save the active car's train keyframes and constraint wiring to a file"
+
+	filename_ext = ".npz"
+	filter_glob = bpy.props.StringProperty(default="*.npz", options={'HIDDEN'})
+
+	@classmethod
+	def poll(cls, context):
+		return context.active_object is not None and has_train(context.active_object)
+
+	def execute(self, context):
+		engine = train_engine(context.active_object)
+		state = load_train(engine)
+		if state.get('shared'):
+			self.report({'ERROR'}, "Trains with a shared action can't be exported, add cars without Shared Action first")
+			return {'CANCELLED'}
+		rigs = [[context.scene.objects.get(name) for name in names] for names in state['rigs']]
+		if any(None in rig for rig in rigs):
+			self.report({'ERROR'}, "Some of this train's cars are gone, add cars again first")
+			return {'CANCELLED'}
+		export_train(rigs, state, self.filepath)
+		return {'FINISHED'}
+
+
+class TrainCarImport(bpy.types.Operator, ImportHelper):
+	bl_idname = "object.traincar_import"
+	bl_label = "Import Train"
+	bl_description = "Lay out a saved train from the active car and the objects selected with it"
+	bl_options = {'REGISTER', 'UNDO'}
+
+	filename_ext = ".npz"
+	filter_glob = bpy.props.StringProperty(default="*.npz", options={'HIDDEN'})
+
+	@classmethod
+	def poll(cls, context):
+		return context.active_object is not None and context.active_object.rigid_body is not None
+
+	def execute(self, context):
+		scene = context.scene
+		rig = template_rig(context.active_object)
+		try:
+			rigs = import_train(rig, self.filepath, scene)
+		except (IOError, KeyError, ValueError) as e:
+			self.report({'ERROR'}, str(e))
+			return {'CANCELLED'}
+		select_rig(rig, rigs[-1], scene)
+		scene.update()
+		return {'FINISHED'}
+
 
 class TrainCarPanel(bpy.types.Panel):
 	bl_label = "Traincar"
@@ -185,37 +413,247 @@ class TrainCarPanel(bpy.types.Panel):
 		col = layout.column(align=True)
 		row = col.row(align=True)
 		row.operator("object.traincar", text = "Add cars", icon='AUTO')
+		row = col.row(align=True)
+		row.operator("object.traincar_tune", text = "Tune physics", icon='PHYSICS')
+		row = col.row(align=True)
+		row.operator("object.traincar_export", text = "Export", icon='EXPORT')
+		row.operator("object.traincar_import", text = "Import", icon='IMPORT')
+
+		if profile_summary:
+			# slowest phases first
+			col = layout.column(align=True)
+			col.label(text="Last run {:.3f}s, {} ops outside phases".format(profile_summary['seconds'], profile_summary['ops_outside_phases']))
+			for name, phase in sorted(profile_summary['phases'].items(), key=lambda item: -item[1]['seconds']):
+				col.label(text="{}: {:.3f}s, {} calls, {} ops".format(name, phase['seconds'], phase['calls'], phase['ops']))
+			col.label(text="Made " + ", ".join("{} {}".format(count, kind) for kind, count in sorted(profile_summary['created'].items()) if count))
+
+
+
+
+def derail_type(derail_at, derail_obj_type):
+	# TrainCarAdd's derail settings to do_traincars's derail_type
+	if derail_at in ('OBJ','GROUP'):
+		return 'BOUND' if derail_obj_type == 'BOUND' else 'OBJ'
+	return derail_at
+
+
+def derail_val(derail_at, derail_obj, derail_group, derail_loc, derail_frame, derail_frame_spacing):
+	# TrainCarAdd's derail settings to do_traincars's derail_val
+	if derail_at == 'OBJ':
+		return derail_obj
+	if derail_at == 'GROUP':
+		group = bpy.data.groups.get(derail_group)
+		return [obj.name for obj in group.objects] if group else None
+	if derail_at == 'LOC':
+		return derail_loc
+	return (derail_frame,derail_frame_spacing)
+
 
+def template_rig(car):
+	# the car body plus everything selected with it (constraint objects, etc), car first
+	return [car] + [obj for obj in bpy.context.selected_objects if obj != car]
 
 
+def attached_rig(car, scene):
+	# the car body plus the rigid body constraints hooked to it, for when nothing is selected
+	return [car] + [obj for obj in scene.objects if obj.rigid_body_constraint and car in (obj.rigid_body_constraint.object1, obj.rigid_body_constraint.object2)]
 
-def duplicate(spacing):
-	current_car = bpy.context.active_object #car body should be active element for proper linking
 
-	# Linked Duplication
-	bpy.ops.object.duplicate_move_linked(
-		TRANSFORM_OT_translate={
-			'value': ( spacing[0], spacing[1], spacing[2] ),
-			'constraint_orientation':'GLOBAL'
-		} )
-	bpy.ops.object.make_single_user(animation=True) # allows for separate keyframe times for traincar and constraints
+def world_to_local(obj, vec):
+	# convert a global-space offset into obj's location space
+	if not obj.parent:
+		return vec
+	return (obj.parent.matrix_world * obj.matrix_parent_inverse).to_3x3().inverted() * vec
 
-	new_car = bpy.context.active_object # get next car object handle
+
+def anchor(obj, rig):
+	# an end hooked to something that stays put outside the train, like the ground
+	return obj is not None and obj not in rig and (obj.rigid_body is None or obj.rigid_body.type == 'PASSIVE')
+
+
+def constraint_map(rig):
+	###
+	# Which cars each rigid body constraint in rig links, by its index in the rig.
+	#  Built once from the template rig, every copy is wired from it by lookup.
+	#  Each entry is (index, object1 slot, object2 slot), slots being 'FRONT' for
+	#  the car ahead, 'CAR' for the rig's own car, or None to keep an end hooked
+	#  to the anchor it already is. Anything but an anchor couples the car ahead
+	#  to this one, the way every copied constraint always got rewired
+	###
+	links = []
+	for i, obj in enumerate(rig):
+		constraint = obj.rigid_body_constraint
+		if not constraint:
+			continue
+		fixed1 = anchor(constraint.object1, rig)
+		fixed2 = anchor(constraint.object2, rig)
+		if fixed1 or fixed2: # holds the car to the scene
+			links.append((i, None if fixed1 else 'CAR', None if fixed2 else 'CAR'))
+		else:
+			links.append((i, 'FRONT', 'CAR'))
+	return links
+
+
+def duplicate(spacing, rig, scene, single_user=True, links=None):
+	###
+	# Linked duplication through bpy.data
+	#  same result as duplicate_move_linked + make_single_user(animation=True),
+	#  without the operator overhead and scene update each call brings along.
+	#  rig[0] is the car body. single_user=False keeps the actions shared.
+	#  links is constraint_map of the template rig, needed once rig is itself a copy
+	###
+	current_car = rig[0]
+	if links is None:
+		links = constraint_map(rig)
+	offset = Vector(spacing)
+
+	copies = {}
+	for obj in rig:
+		new_obj = obj.copy() # object data (mesh) stays linked
+		new_obj.select = False
+		if single_user and obj.animation_data and obj.animation_data.action:
+			# allows for separate keyframe times for traincar and constraints
+			new_obj.animation_data.action = obj.animation_data.action.copy()
+		scene.objects.link(new_obj)
+		for group in obj.users_group: # rigid body world, constraint groups, etc
+			group.objects.link(new_obj)
+		copies[obj.name] = new_obj
+
+	for obj in rig:
+		new_obj = copies[obj.name]
+		if obj.parent and obj.parent.name in copies:
+			new_obj.parent = copies[obj.parent.name] # moves along with its copied parent
+		else:
+			new_obj.location = obj.location + world_to_local(obj, offset)
+
+	new_car = copies[current_car.name]
+	new_rig = [copies[obj.name] for obj in rig]
 
 	###
 	# Reassign physics constraints links between cars
 	#  special lil' handy bit to reassign any rigid body constraints
 	#  that were copied to be between each car now
 	###
-	for obj in bpy.context.selected_objects:
-		if obj.rigid_body_constraint != None:
-			obj.rigid_body_constraint.object1 = current_car
-			obj.rigid_body_constraint.object2 = new_car
+	slots = {'FRONT': current_car, 'CAR': new_car}
+	for i, slot1, slot2 in links:
+		constraint = new_rig[i].rigid_body_constraint
+		if slot1:
+			constraint.object1 = slots[slot1]
+		if slot2:
+			constraint.object2 = slots[slot2]
+
+	return (current_car,new_car,new_rig)
+
+
+def select_rig(old_rig, new_rig, scene):
+	# leave selection the way the duplicate operator would have
+	for obj in old_rig:
+		obj.select = False
+	for obj in new_rig:
+		obj.select = True
+	scene.objects.active = new_rig[0]
+
+
+###
+# Proxy physics
+#  cars can be simulated as a plain box (or convex hull) stand-in instead of their
+#  full geometry. The real car goes in a "<car>-Visual" group, drawn on every proxy
+#  by a group instance parented to it. It sits out the simulation on a hidden layer,
+#  without a rigid body or keys of its own
+###
+PROXY_LAYER = 19 # 0-indexed
+PROXY_LAYER_MASK = [i == PROXY_LAYER for i in range(20)]
+BOX_FACES = ((0,1,2,3), (4,7,6,5), (0,4,5,1), (1,5,6,2), (2,6,7,3), (4,0,3,7)) # bound_box corner order
+
+
+def proxy_mesh(car, shape):
+	bm = bmesh.new()
+	if shape == 'CONVEX_HULL' and car.type == 'MESH':
+		bm.from_mesh(car.data)
+		hull = bmesh.ops.convex_hull(bm, input=bm.verts)
+		bmesh.ops.delete(bm, geom=hull['geom_interior'] + hull['geom_unused'], context=1) # 1: vertices
+	else:
+		corners = [bm.verts.new(corner) for corner in car.bound_box]
+		for face in BOX_FACES:
+			bm.faces.new([corners[i] for i in face])
+	mesh = bpy.data.meshes.new(car.name + "-Proxy")
+	bm.to_mesh(mesh)
+	bm.free()
+	return mesh
+
 
-	return (current_car,new_car)
+def make_proxy_rig(rig, scene, shape):
+	###
+	# Swaps the car at rig[0] for a proxy carrying the car as a group instance.
+	#  The proxy takes over the car's rigid body and animation, so the real car
+	#  loses both (it would otherwise be simulated, and moved by its keys on top
+	#  of the proxy moving the instance) and goes out of sight on PROXY_LAYER
+	###
+	car = rig[0]
+	if car.get('traincar_proxy'): # already is one
+		return rig
+
+	visual = bpy.data.groups.get(car.name + "-Visual") or bpy.data.groups.new(car.name + "-Visual")
+	if car.name not in visual.objects:
+		visual.objects.link(car)
+	visual.layers = PROXY_LAYER_MASK
+
+	proxy = car.copy() # same transform, rigid body settings and animation
+	proxy.data = proxy_mesh(car, shape)
+	proxy.name = car.name + "-Proxy"
+	proxy['traincar_proxy'] = car.name
+	for modifier in list(proxy.modifiers):
+		proxy.modifiers.remove(modifier)
+	proxy.draw_type = 'WIRE'
+	proxy.hide_render = True
+	proxy.select = False
+	if proxy.animation_data and proxy.animation_data.action:
+		proxy.animation_data.action = proxy.animation_data.action.copy()
+	scene.objects.link(proxy)
+	for group in car.users_group:
+		if group != visual:
+			group.objects.link(proxy)
+	proxy.rigid_body.collision_shape = shape
+
+	# instance sits where the car was relative to the proxy, so the car draws wherever the proxy goes
+	instance = bpy.data.objects.new(car.name + "-Visual", None)
+	instance.dupli_type = 'GROUP'
+	instance.dupli_group = visual
+	scene.objects.link(instance)
+	instance.layers = car.layers
+	instance.parent = proxy
+	instance.matrix_parent_inverse = car.matrix_world.inverted()
+
+	# the real car sits out the simulation, standing still, out of sight
+	if car.rigid_body:
+		bpy.ops.rigidbody.object_remove({'object': car, 'active_object': car, 'scene': scene})
+	world = scene.rigidbody_world
+	if world and world.group and car.name in world.group.objects:
+		world.group.objects.unlink(car)
+	car.animation_data_clear() # the proxy has its own copy
+	car.layers = PROXY_LAYER_MASK
+	car.select = False
+
+	for obj in rig[1:]:
+		constraint = obj.rigid_body_constraint
+		if constraint:
+			if constraint.object1 == car:
+				constraint.object1 = proxy
+			if constraint.object2 == car:
+				constraint.object2 = proxy
+
+	return [proxy, instance] + rig[1:]
+
+
+def shared_car(car):
+	anim = car.animation_data
+	return anim is not None and ((anim.action is not None and anim.action.get('traincar_shared')) or
+		any(track.name in SHARED_TRACKS for track in anim.nla_tracks))
 
 
 def get_or_make_curves(car):
+	if shared_car(car):
+		unshare_car(car) # keyframes of its own from here on
 	if not car.animation_data:
 		car.animation_data_create()
 	if not car.animation_data.action:
@@ -252,18 +690,166 @@ def get_or_make_curves(car):
 	return (fx,fy,fz,kf_animated)
 
 
-def start_movement(start_position,start_frame,curves):
+# enum values of KeyframePoint.interpolation, for bulk access
+INTERPOLATION = {'CONSTANT':0, 'LINEAR':1, 'BEZIER':2}
+KEY_THRESHOLD = 0.01 # keys closer than this many frames count as the same key, same as keyframe_points.insert
+
+
+def set_interpolation(points, indices, modes):
+	try:
+		ipo = np.empty(len(points), dtype=np.int32)
+		points.foreach_get('interpolation', ipo)
+		ipo[indices] = [INTERPOLATION[mode] for mode in modes]
+		points.foreach_set('interpolation', ipo)
+	except (TypeError, RuntimeError): # older builds can't bulk access enum properties
+		for i, mode in zip(indices, modes):
+			points[i].interpolation = mode
+
+
+def write_keyframes(curve, keys):
+	###
+	# Bulk keyframe_points.insert for a list of (frame, value, interpolation):
+	#  keys landing on an existing frame replace it, the rest are allocated
+	#  with a single add(), then the curve is sorted and handles recalculated once.
+	#  interpolation None leaves the existing/default interpolation alone
+	###
+	latest = {}
+	for frame, value, mode in keys:
+		# later keys for the same frame win, like repeated inserts, but an earlier
+		#  key's interpolation stays unless the later one sets its own
+		if mode is None and frame in latest:
+			mode = latest[frame][1]
+		latest[frame] = (value, mode)
+	frames = np.array(sorted(latest), dtype=np.float64)
+	values = np.array([latest[f][0] for f in frames], dtype=np.float64)
+	modes = [latest[f][1] for f in frames]
+
+	points = curve.keyframe_points
+	count = len(points)
+	co = np.empty(count*2, dtype=np.float32)
+	points.foreach_get('co', co)
+	co = co.reshape(-1,2)
+
+	# match against existing keys
+	index = np.full(len(frames), -1, dtype=np.int64)
+	if count:
+		order = np.argsort(co[:,0], kind='mergesort')
+		existing = co[order,0]
+		for near in (np.searchsorted(existing, frames) - 1, np.searchsorted(existing, frames)):
+			near = np.clip(near, 0, count-1)
+			same = (index < 0) & (np.abs(existing[near] - frames) < KEY_THRESHOLD)
+			index[same] = order[near[same]]
+	new = index < 0
+	index[new] = count + np.arange(np.count_nonzero(new))
+
+	points.add(int(np.count_nonzero(new)))
+	co = np.concatenate((co, np.zeros((len(points)-count, 2), dtype=np.float32)))
+	co[index,0] = frames
+	co[index,1] = values
+	points.foreach_set('co', co.ravel())
+
+	changed = [(i, mode) for i, mode in zip(index, modes) if mode is not None]
+	if changed:
+		set_interpolation(points, [int(i) for i,mode in changed], [mode for i,mode in changed])
+
+	curve.update() # sort and recalculate handles, once
+
+
+# per key fields carried along when keys get shuffled around
+KEY_FLOATS = (('co',2), ('handle_left',2), ('handle_right',2), ('amplitude',1), ('back',1), ('period',1))
+KEY_FLAGS = ('select_control_point', 'select_left_handle', 'select_right_handle')
+KEY_ENUMS = ('interpolation', 'handle_left_type', 'handle_right_type', 'easing', 'type')
+
+
+def delete_keyframes(curve, after, upto):
+	###
+	# Remove every key with after < frame <= upto in linear time:
+	#  read all keys once, slide the keys we keep down over the gap in bulk,
+	#  then trim the leftover keys off the end (where removing is cheap)
+	###
+	points = curve.keyframe_points
+	count = len(points)
+	co = np.empty(count*2, dtype=np.float32)
+	points.foreach_get('co', co)
+	frames = co[0::2]
+	kept = (frames <= after) | (frames > upto)
+	if kept.all():
+		return
+	keep = np.flatnonzero(kept)
+	first = int(np.argmin(kept)) # first key to go, everything before it stays put
+
+	for attr, size in KEY_FLOATS:
+		data = np.empty(count*size, dtype=np.float32)
+		points.foreach_get(attr, data)
+		data = data.reshape(count, size)
+		data[:len(keep)] = data[keep]
+		points.foreach_set(attr, data.ravel())
+	for attr in KEY_FLAGS:
+		data = np.empty(count, dtype=bool)
+		points.foreach_get(attr, data)
+		data[:len(keep)] = data[keep]
+		points.foreach_set(attr, data)
+	for attr in KEY_ENUMS:
+		try:
+			data = np.empty(count, dtype=np.int32)
+			points.foreach_get(attr, data)
+			data[:len(keep)] = data[keep]
+			points.foreach_set(attr, data)
+		except (TypeError, RuntimeError): # older builds can't bulk access enum properties
+			for i in range(first, len(keep)): # sources always sit at or after i, so nothing is read after being overwritten
+				setattr(points[i], attr, getattr(points[int(keep[i])], attr))
+
+	for i in range(count - len(keep)):
+		points.remove(points[-1], fast=True)
+
+	curve.update()
+
+
+class KeyframeBatch(object):
+	"""Collects keyframe edits for any number of F-Curves, to write each curve in one go"""
+
+	def __init__(self):
+		self.curves = {}
+
+	def _edits(self, curve):
+		return self.curves.setdefault(curve.as_pointer(), (curve, [], []))
+
+	def delete(self, curve, after, upto):
+		# drop existing keys in (after, upto], done before any inserts
+		self._edits(curve)[1].append((after, upto))
+
+	def insert(self, curve, frame, value, interpolation=None):
+		self._edits(curve)[2].append((frame, value, interpolation))
+
+	def insert_many(self, curve, frames, values, interpolation=None):
+		self._edits(curve)[2].extend((float(frame), float(value), interpolation) for frame, value in zip(frames, values))
+
+	def write(self):
+		for curve, deletes, keys in self.curves.values():
+			for after, upto in deletes:
+				delete_keyframes(curve, after, upto)
+			if keys:
+				write_keyframes(curve, keys)
+		self.curves.clear()
+
+
+def start_movement(start_position,start_frame,curves,batch=None):
 	(fx,fy,fz,kf_animated) = curves
+	keys = batch if batch is not None else KeyframeBatch()
 
 	# Initial keyframes
-	kf_animated.keyframe_points.insert(start_frame,1).interpolation = 'CONSTANT' # "Animated" = True keyframed at frame 1
-	fx.keyframe_points.insert(start_frame, start_position[0]).interpolation = 'LINEAR'
-	fy.keyframe_points.insert(start_frame, start_position[1]).interpolation = 'LINEAR'
-	fz.keyframe_points.insert(start_frame, start_position[2]).interpolation = 'LINEAR'
+	keys.insert(kf_animated, start_frame, 1, 'CONSTANT') # "Animated" = True keyframed at frame 1
+	keys.insert(fx, start_frame, start_position[0], 'LINEAR')
+	keys.insert(fy, start_frame, start_position[1], 'LINEAR')
+	keys.insert(fz, start_frame, start_position[2], 'LINEAR')
+
+	if batch is None:
+		keys.write()
 
 
-def move_forever(start_position,start_frame,velocity,curves):
+def move_forever(start_position,start_frame,velocity,curves,batch=None):
 	(fx,fy,fz,kf_animated) = curves
+	keys = batch if batch is not None else KeyframeBatch()
 
 	# set forever motion
 	fx.extrapolation = 'LINEAR'
@@ -271,12 +857,201 @@ def move_forever(start_position,start_frame,velocity,curves):
 	fz.extrapolation = 'LINEAR'
 
 	# put in velocity
-	fx.keyframe_points.insert( start_frame+1, start_position[0] + velocity[0] )
-	fy.keyframe_points.insert( start_frame+1, start_position[1] + velocity[1] )
-	fz.keyframe_points.insert( start_frame+1, start_position[2] + velocity[2] )
+	keys.insert(fx, start_frame+1, start_position[0] + velocity[0])
+	keys.insert(fy, start_frame+1, start_position[1] + velocity[1])
+	keys.insert(fz, start_frame+1, start_position[2] + velocity[2])
+
+	if batch is None:
+		keys.write()
+
+
+def box_entry_frames(starts, velocity, center, half_size, frame_end):
+	###
+	# Closed form slab test: first whole frame i in [0,frame_end) where
+	#  every axis of start + velocity*i is within half_size of center.
+	#  Solves all starts at once, -1 where the box is never reached.
+	###
+	starts = np.asarray(starts, dtype=np.float64).reshape(-1,3)
+	velocity = np.asarray(velocity, dtype=np.float64)
+	center = np.asarray(center, dtype=np.float64)
+	half_size = np.broadcast_to(np.asarray(half_size, dtype=np.float64), (3,))
+
+	enter = np.zeros(len(starts))
+	leave = np.full(len(starts), frame_end - 1.0)
+	for axis in range(3):
+		p = starts[:,axis]
+		if velocity[axis] == 0:
+			# never moves on this axis, so either always or never inside the slab
+			outside = np.abs(p - center[axis]) > half_size[axis]
+			enter[outside] = np.inf
+			continue
+		t1 = (center[axis] - half_size[axis] - p) / velocity[axis]
+		t2 = (center[axis] + half_size[axis] - p) / velocity[axis]
+		enter = np.maximum(enter, np.minimum(t1,t2))
+		leave = np.minimum(leave, np.maximum(t1,t2))
+
+	def inside(frames):
+		pos = starts + velocity * frames[:,None]
+		return np.all(np.abs(pos - center) <= half_size, axis=1) & (frames >= 0) & (frames < frame_end)
+
+	# the slab bounds can land a hair off a whole frame, so settle the
+	#  boundary with the same per-frame test a frame by frame scan would use
+	reachable = np.isfinite(enter) & (enter <= leave + 1)
+	guess = np.where(reachable, np.ceil(np.where(reachable, enter, 0)), -1).astype(np.int64)
+	frames = np.full(len(starts), -1, dtype=np.int64)
+	for shift in (1,0,-1):
+		candidate = guess + shift
+		hit = reachable & inside(candidate)
+		frames[hit] = candidate[hit]
+	return frames
+
+
+# BVH trees of 'BOUND' derail objects, by object name. reused for as long as the object stays put
+obstacle_trees = {}
+
 
+def obstacle_key(obj):
+	# changes whenever the object moves or its mesh gets edited
+	matrix = tuple(v for row in obj.matrix_world for v in row)
+	if obj.type != 'MESH':
+		return (matrix, obj.data.name if obj.data else None)
+	co = np.empty(len(obj.data.vertices)*3, dtype=np.float32)
+	obj.data.vertices.foreach_get('co', co)
+	return (matrix, len(obj.data.polygons), hash(co.tobytes()))
 
-def find_collision_frame(car_n, end_frame, start_position, velocity, derail_type, derail_val, collectively):
+
+def obstacle_tree(obj, scene):
+	key = obstacle_key(obj)
+	cached = obstacle_trees.get(obj.name)
+	if cached is None or cached[0] != key:
+		tree = BVHTree.FromObject(obj, scene) if obj.type in ('MESH','CURVE','SURFACE','FONT','META') else None
+		cached = obstacle_trees[obj.name] = (key, tree)
+	return cached[1]
+
+
+def world_bounds(obj):
+	corners = np.array([tuple(obj.matrix_world * Vector(corner)) for corner in obj.bound_box])
+	return corners.min(axis=0), corners.max(axis=0)
+
+
+def inside_mesh(tree, point):
+	# nearest surface faces away from us when we're inside (assumes a closed mesh)
+	location, normal, index, distance = tree.find_nearest(point)
+	return location is not None and (location - point).dot(normal) > 0
+
+
+def bound_frames(starts, velocity, obj, scene):
+	###
+	# First frame each car center is inside obj, None if never.
+	#  The object's world bounding box rules out cars that never get near it
+	#  in one batch, the rest get a single ray cast along their path against
+	#  the object's BVH tree (in object space)
+	###
+	frame_end = scene.frame_end
+	low, high = world_bounds(obj)
+	in_box = box_entry_frames(starts, velocity, (low+high)/2, (high-low)/2, frame_end)
+	tree = obstacle_tree(obj, scene)
+	if tree is None: # nothing to cast against, the bounding box is all there is
+		return [int(f) if f >= 0 else None for f in in_box]
+
+	to_world = obj.matrix_world
+	to_local = to_world.inverted()
+	velocity = Vector(velocity)
+	direction = to_local.to_3x3() * velocity
+
+	frames = []
+	for start, box_frame in zip(starts, in_box):
+		if box_frame < 0:
+			frames.append(None)
+			continue
+		start = Vector(start)
+		origin = to_local * start
+		if inside_mesh(tree, origin):
+			frames.append(0)
+			continue
+		hit = tree.ray_cast(origin, direction)[0] if velocity.length_squared else None
+		if hit is None:
+			frames.append(None)
+			continue
+		# back to frames along the world space path
+		frame = max(0, int(math.ceil((to_world * hit - start).dot(velocity) / velocity.length_squared)))
+		frames.append(frame if frame < frame_end else None)
+	return frames
+
+
+def collision_frames(starts, velocity, point, tolerance=2.0):
+	# frame each car center gets within tolerance of point, None if not in the frame range
+	frames = box_entry_frames(starts, velocity, point, tolerance, bpy.context.scene.frame_end)
+	return [int(f) if f >= 0 else None for f in frames]
+
+
+def obstacle_frames(starts, velocity, names, derail_type, tolerance, scene):
+	###
+	# Earliest frame each car reaches any of the named obstacles, None if none.
+	#  Every car runs down a straight line along velocity, so obstacles are indexed
+	#  once in a KD tree of their centers flattened onto the plane across that line.
+	#  One range lookup per car finds the few obstacles near its line, and only
+	#  those get the exact test, batched per obstacle
+	###
+	objects = [scene.objects[name] for name in names if name in scene.objects]
+	if not objects:
+		return [None]*len(starts)
+	starts = [Vector(start) for start in starts]
+	velocity = Vector(velocity)
+	axis = velocity.normalized() if velocity.length_squared else None
+
+	def across(point):
+		# drop the part along the direction of travel (standing trains only have their start point to go on)
+		return point - axis * point.dot(axis) if axis is not None else point
+
+	if derail_type == 'BOUND':
+		centers, reach = [], 0
+		for obj in objects:
+			low, high = world_bounds(obj)
+			centers.append(Vector((low+high)/2))
+			reach = max(reach, Vector((high-low)/2).length)
+	else:
+		centers = [obj.location for obj in objects]
+		reach = tolerance * math.sqrt(3) # corner of the tolerance box
+	reach += 1e-5 # don't lose obstacles right on the edge to rounding
+
+	index = KDTree(len(objects))
+	for i, center in enumerate(centers):
+		index.insert(across(center), i)
+	index.balance()
+
+	nearby = {} # obstacle -> cars whose path passes close by
+	for n, start in enumerate(starts):
+		for co, i, dist in index.find_range(across(start), reach):
+			nearby.setdefault(i, []).append(n)
+
+	frames = [None]*len(starts)
+	for i, cars in nearby.items():
+		passing = [starts[n] for n in cars]
+		if derail_type == 'BOUND':
+			hits = bound_frames(passing, velocity, objects[i], scene)
+		else:
+			hits = collision_frames(passing, velocity, centers[i], tolerance)
+		for n, frame in zip(cars, hits):
+			if frame is not None and (frames[n] is None or frame < frames[n]):
+				frames[n] = frame
+	return frames
+
+
+def derail_collisions(starts, velocity, derail_type, derail_val, tolerance=2.0):
+	###
+	# Collision frame for each start position, for 'LOC', 'OBJ' and 'BOUND' derails.
+	#  derail_val is the location, or one or more obstacle object names
+	###
+	if not derail_val:	# we don't have a location or object set yet so hold off
+		return [None]*len(starts)
+	if derail_type == 'LOC':
+		return collision_frames(starts, velocity, derail_val, tolerance)
+	names = [derail_val] if isinstance(derail_val, str) else derail_val
+	return obstacle_frames(starts, velocity, names, derail_type, tolerance, bpy.context.scene)
+
+
+def find_collision_frame(car_n, end_frame, start_position, velocity, derail_type, derail_val, collectively, tolerance=2.0):
 	if derail_type == 'FRAME':
 		# Determine final on-rails frame for this car
 		return derail_val[0] if collectively else derail_val[0] + (car_n+1)*derail_val[1]
@@ -288,90 +1063,1215 @@ def find_collision_frame(car_n, end_frame, start_position, velocity, derail_type
 	if collectively and end_frame is not None:
 		return end_frame
 
-	# determine where we are crashing
-	point = derail_val if derail_type == 'LOC' else bpy.context.scene.objects[derail_val].location if derail_val else None
-	if not point:	# we don't have a location set yet so hold off
-		return None
+	# @todo: notify if collisions not found in current frame range?
+	return derail_collisions([start_position], velocity, derail_type, derail_val, tolerance)[0]
 
 
-	# @todo: notify if collisions not found in current frame range?
-	# @todo: <= 2 blender units also magic number.
-	for i in range(bpy.context.scene.frame_end):
-		if abs( (start_position[0]+velocity[0]*i) - point[0] ) <= 2 and \
-		   abs( (start_position[1]+velocity[1]*i) - point[1] ) <= 2 and \
-		   abs( (start_position[2]+velocity[2]*i) - point[2] ) <= 2:
-			return i
+def derail_frames(cars, velocity, derail_type, derail_val, collectively, tolerance=2.0):
+	# final on-rails frame for every car, in one go. cars[0] is the engine
+	if derail_type == 'FRAME':
+		return [find_collision_frame(n-1, None, car.location, velocity, derail_type, derail_val, collectively) for n,car in enumerate(cars)]
 
-	return None # no collision found
+	frames = derail_collisions([car.location for car in cars], velocity, derail_type, derail_val, tolerance)
+	return collective_frames(frames) if collectively else frames
 
 
+def collective_frames(frames):
+	# the first car to reach the point stops everyone behind it
+	first = next((n for n,frame in enumerate(frames) if frame is not None), len(frames))
+	return [None]*first + [frames[first]]*(len(frames)-first)
 
-def end_movement(start_frame, end_frame, start_position, velocity, curves):
+
+
+def end_movement(start_frame, end_frame, start_position, velocity, curves, batch=None):
 	(fx,fy,fz,kf_animated) = curves
+	keys = batch if batch is not None else KeyframeBatch()
 
 	# delete any existing keyframes that would interfere with our motion here
-	for key in kf_animated.keyframe_points:
-		if key.co.x > start_frame and key.co.x <= end_frame+1:
-			kf_animated.keyframe_points.remove(key) # @todo: will removing a key while looping bork the looping?
+	keys.delete(kf_animated, start_frame, end_frame+1)
 	for curve in (fx,fy,fz):
-		for key in curve.keyframe_points:
-			if key.co.x > start_frame and key.co.x <= end_frame:
-				curve.keyframe_points.remove(key)
+		keys.delete(curve, start_frame, end_frame)
 
 	# make our controlled keyframes
-	kf_animated.keyframe_points.insert(end_frame+1, 0) # turn off keyframed motion, use rigid body phys now
-	fx.keyframe_points.insert(end_frame, start_position[0] + velocity[0] * end_frame)
-	fy.keyframe_points.insert(end_frame, start_position[1] + velocity[1] * end_frame)
-	fz.keyframe_points.insert(end_frame, start_position[2] + velocity[2] * end_frame)
+	keys.insert(kf_animated, end_frame+1, 0) # turn off keyframed motion, use rigid body phys now
+	keys.insert(fx, end_frame, start_position[0] + velocity[0] * end_frame)
+	keys.insert(fy, end_frame, start_position[1] + velocity[1] * end_frame)
+	keys.insert(fz, end_frame, start_position[2] + velocity[2] * end_frame)
 
+	if batch is None:
+		keys.write()
 
-def do_traincars(spacing=(0,0,0),amount=1,velo=(0,0,0),derail=True,collectively=True,derail_type='FRAME',derail_val=None):
-	start_frame = 1 # note: bpy.context.scene.frame_current may be helpful in the future
-	end_frame = None
 
+def key_cars(cars, end_frames, start_frame, velo, derail, keys):
+	# Motion Keyframing for each car, into a KeyframeBatch
+	for car, end_frame in zip(cars, end_frames):
+		curves = get_or_make_curves(car)
+
+		start_movement(car.location, start_frame, curves, keys)
+
+		if not derail:
+			move_forever(car.location,start_frame,velo, curves, keys)
+			continue
+		#only derailing trains below
+
+		if end_frame is None: # info not set yet, or no collision found
+			continue
+
+		# Set final keyframes at crash time
+		end_movement(start_frame, end_frame, car.location, velo, curves, keys)
 
-	# first iteration for principal engine car
-	car = bpy.context.active_object
-	curves = get_or_make_curves(car)
-	start_movement(car.location, start_frame, curves)
+
+def unkey_car(car, start_frame, end_frame, derail, keys):
+	# clear what key_cars put down after start_frame
+	(fx,fy,fz,kf_animated) = get_or_make_curves(car)
 	if not derail:
-		move_forever(car.location,start_frame,velo,curves)
+		for curve in (fx,fy,fz):
+			keys.delete(curve, start_frame, start_frame+1)
+			curve.extrapolation = 'CONSTANT'
+	elif end_frame is not None:
+		keys.delete(kf_animated, start_frame, end_frame+1)
+		for curve in (fx,fy,fz):
+			keys.delete(curve, start_frame, end_frame)
+
+
+###
+# Track mode
+#  cars follow a curve object instead of a straight line. The curve is sampled
+#  once into a table of world space points and the distance along the track to
+#  each, then every car's position on every frame is a binary search for its
+#  segment in that table plus interpolation along it. Derail frames are found
+#  against the same per-frame positions
+###
+
+TRACK_RESOLUTION = 32 # fewest samples per curve segment
+EULER_MODES = ('XYZ','XZY','YXZ','YZX','ZXY','ZYX')
+
+
+def track_points(obj, scene):
+	# world space points along the curve's first spline, in order, and whether it loops
+	data = obj.data.copy()
+	for spline in list(data.splines)[1:]:
+		data.splines.remove(spline)
+	if not data.splines:
+		bpy.data.curves.remove(data)
+		raise ValueError("track {} has no splines".format(obj.name))
+	spline = data.splines[0]
+	spline.resolution_u = max(spline.resolution_u, TRACK_RESOLUTION)
+	cyclic = spline.use_cyclic_u
+
+	# just the wire, none of the bevel or extrude geometry
+	data.dimensions = '3D'
+	data.bevel_depth = 0
+	data.bevel_object = None
+	data.extrude = 0
+
+	temp = bpy.data.objects.new(obj.name + "-Track", data)
+	mesh = temp.to_mesh(scene, False, 'PREVIEW')
+	co = np.empty(len(mesh.vertices)*3, dtype=np.float32)
+	mesh.vertices.foreach_get('co', co)
+	bpy.data.objects.remove(temp)
+	bpy.data.meshes.remove(mesh)
+	bpy.data.curves.remove(data)
+
+	matrix = np.array(obj.matrix_world)
+	return co.reshape(-1,3).astype(np.float64).dot(matrix[:3,:3].T) + matrix[:3,3], cyclic
+
+
+class Track(object):
+	"""Distance along a curve object to world position and heading, through a precomputed table"""
+
+	def __init__(self, obj, scene):
+		points, self.cyclic = track_points(obj, scene)
+		if self.cyclic and len(points) > 1:
+			points = np.vstack((points, points[:1]))
+		if len(points) > 1: # no zero length segments
+			points = points[np.concatenate(([True], np.linalg.norm(np.diff(points, axis=0), axis=1) > 1e-9))]
+		if len(points) < 2:
+			raise ValueError("track {} is too short".format(obj.name))
+
+		self.name = obj.name
+		self.points = points
+		self.lengths = np.concatenate(([0], np.cumsum(np.linalg.norm(np.diff(points, axis=0), axis=1))))
+		self.total = self.lengths[-1]
+
+		# heading around Z at each point from its neighbours, unwrapped so it interpolates smoothly
+		tangents = np.empty_like(points)
+		tangents[1:-1] = points[2:] - points[:-2]
+		tangents[0] = points[1] - points[0]
+		tangents[-1] = points[-1] - points[-2]
+		if self.cyclic:
+			tangents[0] = tangents[-1] = points[1] - points[-2]
+		self.yaw = np.unwrap(np.arctan2(tangents[:,1], tangents[:,0]))
+
+	def segments(self, distance):
+		# segment each distance falls in, and how far along it
+		if self.cyclic:
+			distance = np.mod(distance, self.total)
+		i = np.clip(np.searchsorted(self.lengths, distance, side='right') - 1, 0, len(self.lengths)-2)
+		return i, (distance - self.lengths[i]) / (self.lengths[i+1] - self.lengths[i])
+
+	def position(self, distance):
+		# past either end of an open track, carries on straight
+		i, t = self.segments(distance)
+		return self.points[i] + (self.points[i+1] - self.points[i]) * t[...,None]
+
+	def heading(self, distance):
+		# unwrapped along the last axis, so a car looping round doesn't spin at the seam
+		i, t = self.segments(distance)
+		t = np.clip(t, 0, 1)
+		return np.unwrap(self.yaw[i] + (self.yaw[i+1] - self.yaw[i]) * t, axis=-1)
+
+	def locate(self, point):
+		# distance along the track to its closest point to point
+		starts = self.points[:-1]
+		steps = np.diff(self.points, axis=0)
+		point = np.asarray(point, dtype=np.float64)
+		t = np.clip(((point - starts) * steps).sum(axis=1) / (steps * steps).sum(axis=1), 0, 1)
+		i = int(np.argmin(((starts + steps * t[:,None] - point)**2).sum(axis=1)))
+		return self.lengths[i] + t[i] * (self.lengths[i+1] - self.lengths[i])
+
+
+def keyed_value(obj, data_path, index, frame, default):
+	# obj's animated value at frame, or default when it isn't keyed
+	action = obj.animation_data.action if obj.animation_data else None
+	curve = action.fcurves.find(data_path, index) if action else None
+	return curve.evaluate(frame) if curve else default
+
+
+def rewind(car, frame):
+	# put car's location and rotation back the way its keys have them at frame
+	for i in range(3):
+		car.location[i] = keyed_value(car, 'location', i, frame, car.location[i])
+		car.rotation_euler[i] = keyed_value(car, 'rotation_euler', i, frame, car.rotation_euler[i])
+
+
+def get_or_make_yaw_curve(car):
+	action = car.animation_data.action
+	return action.fcurves.find('rotation_euler', 2) or action.fcurves.new('rotation_euler', index=2, action_group="train")
+
+
+def world_location(obj):
+	# from location alone, matrix_world can be stale right after duplicate moves things
+	if not obj.parent:
+		return Vector(obj.location)
+	return obj.parent.matrix_world * obj.matrix_parent_inverse * Vector(obj.location)
+
+
+def set_world_location(obj, location):
+	if not obj.parent:
+		obj.location = location
 	else:
-		end_frame = find_collision_frame(-1,end_frame,car.location,velo, derail_type,derail_val, collectively)
-		if end_frame:
-			end_movement(start_frame, end_frame, car.location, velo, curves)
-
-	for i in range(amount): # loop to do this for every new car
+		obj.location = (obj.parent.matrix_world * obj.matrix_parent_inverse).inverted() * Vector(location)
 
-		current_car, new_car = duplicate(spacing)
 
-		# Motion Keyframing
-		curves = get_or_make_curves(new_car)
+def place_rigs(rigs, positions, yaws):
+	###
+	# Puts the constraint objects and anything else riding with each car where
+	#  its car starts on the track, turned with it. They keep the layout they have
+	#  around the engine in the first rig, which stays as it is
+	###
+	engine = rigs[0][0]
+	origin = Vector(engine.location)
+	template = [(world_location(obj), obj.rotation_euler[2]) for obj in rigs[0]]
+	for rig, position, yaw in zip(rigs[1:], positions[1:], yaws[1:]):
+		turn = Matrix.Rotation(yaw - engine.rotation_euler[2], 3, 'Z')
+		for obj, (location, rz) in zip(rig[1:], template[1:]):
+			if obj.parent and obj.parent in rig: # children ride along with their parent
+				continue
+			set_world_location(obj, Vector(position) + turn * (location - origin))
+			if obj.rotation_mode in EULER_MODES:
+				obj.rotation_euler[2] = rz + yaw - engine.rotation_euler[2]
+
+
+def track_collisions(frames, positions, derail_type, derail_val, tolerance, scene):
+	###
+	# First of frames each car reaches the derail location or any of the obstacles,
+	#  None if never. positions is every car's world position on every frame
+	###
+	never = len(frames)
+	if not derail_val:
+		return [None]*len(positions)
+	if derail_type == 'LOC':
+		targets = [None]
+	else:
+		names = [derail_val] if isinstance(derail_val, str) else derail_val
+		targets = [scene.objects[name] for name in names if name in scene.objects]
+
+	hits = np.full(len(positions), never, dtype=np.int64)
+	for obj in targets:
+		if derail_type == 'BOUND':
+			low, high = world_bounds(obj)
+			inside = np.all((positions >= low) & (positions <= high), axis=2)
+			tree = obstacle_tree(obj, scene)
+			if tree is not None:
+				# only frames inside the bounding box get the exact test, and only until the first hit
+				to_local = obj.matrix_world.inverted()
+				for n in np.flatnonzero(inside.any(axis=1)):
+					for f in np.flatnonzero(inside[n]):
+						if f >= hits[n]:
+							break
+						if inside_mesh(tree, to_local * Vector(positions[n,f])):
+							hits[n] = f
+							break
+				continue
+		else:
+			center = np.array(derail_val if obj is None else obj.location)
+			inside = np.all(np.abs(positions - center) <= tolerance, axis=2)
+		hits = np.minimum(hits, np.where(inside.any(axis=1), inside.argmax(axis=1), never))
+	return [int(frames[hit]) if hit < never else None for hit in hits]
 
-		start_movement(new_car.location, start_frame, curves )
 
+def track_motion(rigs, track, start_frame, spacing, velo, derail, collectively, derail_type, derail_val, tolerance, keys):
+	###
+	# Keys every car along track into a KeyframeBatch: spaced out behind the engine by
+	#  the length of spacing, moving forward along the track at the length of velo.
+	#  The rest of each rig is placed on the track where its car starts.
+	#  Returns each car's final on-rails frame
+	###
+	scene = bpy.context.scene
+	cars = [rig[0] for rig in rigs]
+	engine = cars[0]
+	rewind(engine, start_frame)
+	speed = Vector(velo).length
+	gap = Vector(spacing).length
+	frames = np.arange(start_frame, max(scene.frame_end, start_frame) + 1)
+
+	along = track.locate(engine.location)
+	offset = np.array(engine.location) - track.position(np.array([along]))[0] # e.g. the car's height above the curve
+	heading = track.heading(np.array([along]))[0]
+	starts = along - gap*np.arange(len(cars))
+	place_rigs(rigs, track.position(starts) + offset, engine.rotation_euler[2] + track.heading(starts) - heading)
+
+	end_frames = [None]*len(cars)
+	if derail and derail_type == 'FRAME':
+		end_frames = derail_frames(cars, velo, derail_type, derail_val, collectively, tolerance)
+	elif derail:
+		positions = track.position(starts[:,None] + speed*(frames - start_frame)) + offset
+		end_frames = track_collisions(frames, positions, derail_type, derail_val, tolerance, scene)
+		if collectively:
+			end_frames = collective_frames(end_frames)
+
+	for car, start, end_frame in zip(cars, starts, end_frames):
+		(fx,fy,fz,kf_animated) = get_or_make_curves(car)
+		if not derail:
+			key_frames = frames
+		elif end_frame is None: # info not set yet, or no collision found. stand at the start
+			key_frames = frames[:1]
+		else:
+			key_frames = frames[frames <= end_frame]
+			if end_frame != int(end_frame): # fractional derail spacing
+				key_frames = np.append(key_frames, end_frame)
+		distance = start + speed*(key_frames - start_frame)
+		positions = track.position(distance) + offset
+
+		# whatever was keyed before goes, the track is keyed start to finish
+		for curve in (fx,fy,fz,kf_animated):
+			keys.delete(curve, start_frame, np.inf)
+		keys.insert(kf_animated, start_frame, 1, 'CONSTANT')
+		if derail and end_frame is not None:
+			keys.insert(kf_animated, end_frame+1, 0) # turn off keyframed motion, use rigid body phys now
+		for i, curve in enumerate((fx,fy,fz)):
+			curve.extrapolation = 'CONSTANT' if derail else 'LINEAR'
+			keys.insert_many(curve, key_frames, positions[:,i], 'LINEAR')
+
+		if car.rotation_mode in EULER_MODES:
+			# turn with the track, relative to how the engine sits on it
+			rz = get_or_make_yaw_curve(car)
+			keys.delete(rz, start_frame, np.inf)
+			rz.extrapolation = fx.extrapolation
+			keys.insert_many(rz, key_frames, engine.rotation_euler[2] + track.heading(distance) - heading, 'LINEAR')
+	return end_frames
+
+
+###
+# Shared action trains
+#  every car plays the same "<engine>-Train" action, moving delta_location so each
+#  car keeps its own start location. A derailing car plays it from an NLA strip
+#  ending at its derail frame, holding there like key_cars' last key, and stands
+#  at its start if it never derails. Derailing is a shared "<engine>-Derail"
+#  action switching rigid_body.kinematic off, played from an NLA strip each car
+#  offsets in time to its own derail frame. Whatever action a car had before
+#  is kept aside (by name, in its "traincar_action" property) for unshare_car
+###
+
+SHARED_TRACKS = ("traincar", "traincar-derail")
+
+def fresh_action(name):
+	action = bpy.data.actions.get(name) or bpy.data.actions.new(name)
+	for curve in list(action.fcurves):
+		action.fcurves.remove(curve)
+	return action
+
+
+def stash_action(car):
+	# keep the car's own action around while it plays shared ones
+	action = car.animation_data.action if car.animation_data else None
+	if action and not action.get('traincar_shared'):
+		car['traincar_action'] = action.name
+		action.use_fake_user = True
+
+
+def unshare_car(car):
+	# back to a car with nothing shared and its own action back, ready for key_cars
+	if car.animation_data:
+		for track in list(car.animation_data.nla_tracks):
+			if track.name in SHARED_TRACKS:
+				car.animation_data.nla_tracks.remove(track)
+		car.animation_data.action = None
+		previous = bpy.data.actions.get(car.get('traincar_action', ""))
+		if previous:
+			if previous.users - previous.use_fake_user: # another car got it back already
+				previous = previous.copy()
+			previous.use_fake_user = False
+			car.animation_data.action = previous
+	if 'traincar_action' in car:
+		del car['traincar_action']
+	car.delta_location = (0,0,0)
+
+
+def share_motion(cars, end_frames, start_frame, velo, derail):
+	engine = cars[0]
+	keys = KeyframeBatch()
+
+	motion = fresh_action(engine.name + "-Train")
+	motion['traincar_shared'] = True
+	for i in range(3):
+		curve = motion.fcurves.new('delta_location', index=i, action_group="train")
+		curve.color_mode = 'AUTO_RGB'
+		curve.extrapolation = 'LINEAR'
+		keys.insert(curve, start_frame, 0, 'LINEAR')
+		keys.insert(curve, start_frame+1, velo[i], 'LINEAR')
+
+	ends = [end_frame for end_frame in end_frames if end_frame is not None]
+	first_end = min(ends) if derail and ends else None
+	if first_end is not None:
+		switch = fresh_action(engine.name + "-Derail")
+		switch['traincar_shared'] = True
+		curve = switch.fcurves.new('rigid_body.kinematic', action_group="train")
+		keys.insert(curve, start_frame, 1, 'CONSTANT')
+		keys.insert(curve, first_end+1, 0, 'CONSTANT') # turn off keyframed motion, use rigid body phys now
+	keys.write()
+
+	for car, end_frame in zip(cars, end_frames):
+		unshare_car(car)
+		if not car.animation_data:
+			car.animation_data_create()
+		stash_action(car)
+		car.rigid_body.kinematic = True
 		if not derail:
-			move_forever(new_car.location,start_frame,velo, curves)
+			car.animation_data.action = motion
 			continue
-		#only derailing trains below
-
-		end_frame = find_collision_frame(i,end_frame, new_car.location, velo, derail_type,derail_val, collectively)
-		if end_frame is None: # info not set yet, or no collision found
+		car.animation_data.action = None
+		if end_frame is None: # info not set yet, or no collision found. stand at the start
 			continue
 
-		# Set final keyframes at crash time
-		end_movement(start_frame, end_frame, new_car.location, velo, curves)
+		# moves until its derail frame and rests there, for the simulation to take over
+		track = car.animation_data.nla_tracks.new()
+		track.name = "traincar"
+		strip = track.strips.new("traincar", start_frame, motion)
+		strip.action_frame_end = max(end_frame, start_frame + 1)
+		strip.extrapolation = 'HOLD'
+
+		# NLA strips start on whole frames, so fractional derail spacing gets rounded here
+		track = car.animation_data.nla_tracks.new()
+		track.name = "traincar-derail"
+		strip = track.strips.new("traincar", int(round(start_frame + end_frame - first_end)), switch)
+		strip.extrapolation = 'HOLD'
+
+
+###
+# Generated train bookkeeping
+#  the engine car keeps a record of the train made from it last time (as JSON in
+#  its "traincar" custom property), every other car points back at its engine
+###
+
+def train_engine(car):
+	name = car.get('traincar_engine')
+	return bpy.context.scene.objects.get(name) if name else car
+
+
+def has_train(car):
+	# without reading the saved train, cheap enough for poll
+	engine = train_engine(car)
+	return engine is not None and 'traincar' in engine
+
+
+def load_train(engine):
+	return json.loads(engine['traincar']) if engine and 'traincar' in engine else None
+
+
+def save_train(rigs, start_frame, spacing, velo, derail, end_frames, shared, track=None):
+	engine = rigs[0][0]
+	engine['traincar'] = json.dumps({
+		'rigs': [[obj.name for obj in rig] for rig in rigs],
+		'start_frame': start_frame,
+		'spacing': list(spacing),
+		'velo': list(velo),
+		'derail': derail,
+		'ends': end_frames,
+		'shared': shared,
+		'track': track,
+	})
+	if 'traincar_engine' in engine:
+		del engine['traincar_engine']
+	for rig in rigs[1:]:
+		if 'traincar' in rig[0]: # copied along from the engine
+			del rig[0]['traincar']
+		rig[0]['traincar_engine'] = engine.name
+
+
+def move_rig(rig, offset):
+	for obj in rig:
+		if not (obj.parent and obj.parent in rig): # children ride along with their parent
+			obj.location = obj.location + world_to_local(obj, offset)
+
+
+def remove_rig(rig):
+	for obj in rig:
+		action = obj.animation_data.action if obj.animation_data else None
+		for scene in obj.users_scene:
+			scene.objects.unlink(obj)
+		for group in obj.users_group:
+			group.objects.unlink(obj)
+		bpy.data.objects.remove(obj)
+		if action and not action.users:
+			bpy.data.actions.remove(action)
+
+
+def update_traincars(state,spacing,amount,velo,derail,collectively,derail_type,derail_val,tolerance,shared,track=None):
+	###
+	# Incremental version of do_traincars, for a train it already made:
+	#  cars get slid over when spacing changes, added or removed at the end
+	#  when the count changes, and only cars whose start, end or motion
+	#  changed get their keyframes rewritten. Only for trains saved before
+	#  the operator ran, see TrainCarAdd.invoke
+	###
+	scene = bpy.context.scene
+	start_frame = state['start_frame']
+
+	# keep the train up to the first car that went missing since
+	rigs = []
+	for names in state['rigs']:
+		rig = [scene.objects.get(name) for name in names]
+		if None in rig:
+			break
+		rigs.append(rig)
+	if not rigs: # the engine's own rig is gone, start over
+		return None
+	old_ends = state['ends'][:len(rigs)]
+
+	for rig in rigs[amount+1:]:
+		remove_rig(rig)
+	del rigs[amount+1:]
+	kept = len(rigs)
+
+	shift = Vector(spacing) - Vector(state['spacing'])
+	if shift.length_squared:
+		for n, rig in enumerate(rigs):
+			move_rig(rig, shift*n)
+
+	rig = rigs[-1]
+	links = constraint_map(rigs[0])
+	for i in range(kept-1, amount):
+		current_car, new_car, rig = duplicate(spacing, rig, scene, single_user=not shared, links=links)
+		rigs.append(rig)
+
+	cars = [rig[0] for rig in rigs]
+	if track:
+		# the whole train gets keyed along the track again
+		keys = KeyframeBatch()
+		end_frames = track_motion(rigs, Track(scene.objects[track], scene), start_frame, spacing, velo, derail, collectively, derail_type, derail_val, tolerance, keys)
+		keys.write()
+		save_train(rigs, start_frame, spacing, velo, derail, end_frames, shared, track)
+		return rigs
+
+	end_frames = [None]*len(cars)
+	if derail:
+		end_frames = derail_frames(cars, velo, derail_type, derail_val, collectively, tolerance)
+
+	was_shared = state.get('shared', False)
+	if shared or was_shared or state.get('track'):
+		# sharing and tracks are all or nothing, (re)build the whole train's animation
+		if shared:
+			share_motion(cars, end_frames, start_frame, velo, derail)
+		else:
+			for car in cars:
+				rewind(car, start_frame)
+				unshare_car(car)
+			keys = KeyframeBatch()
+			key_cars(cars, end_frames, start_frame, velo, derail, keys)
+			keys.write()
+		save_train(rigs, start_frame, spacing, velo, derail, end_frames, shared)
+		return rigs
+
+	same_motion = tuple(velo) == tuple(state['velo']) and derail == state['derail']
+	keys = KeyframeBatch()
+	changed = []
+	for n, (car, end_frame) in enumerate(zip(cars, end_frames)):
+		if n < kept:
+			if same_motion and end_frame == old_ends[n] and (n == 0 or not shift.length_squared):
+				continue
+			unkey_car(car, start_frame, old_ends[n], state['derail'], keys)
+		else:
+			# new cars were copied from the last car we kept, keys and all
+			unkey_car(car, start_frame, old_ends[kept-1], state['derail'], keys)
+		changed.append((car, end_frame))
+	keys.write() # clear before keying, the windows can overlap
+	key_cars([car for car,end in changed], [end for car,end in changed], start_frame, velo, derail, keys)
+	keys.write()
+
+	save_train(rigs, start_frame, spacing, velo, derail, end_frames, shared)
+	return rigs
+
+
+def do_traincars(spacing=(0,0,0),amount=1,velo=(0,0,0),derail=True,collectively=True,derail_type='FRAME',derail_val=None,tolerance=2.0,incremental=False,shared=False,proxy=None,track=None,car=None,rig=None,update=True,select=True):
+	###
+	# Makes (or with incremental, updates) a train behind car, the active object
+	#  by default. rig is what gets duplicated per car, car first; defaults to
+	#  the car plus the selected objects. track names a curve object for the
+	#  train to follow instead of heading straight along velo. update=False
+	#  leaves the scene update to the caller, for making many trains at once,
+	#  and select=False leaves the selection as it was. Returns every car's rig
+	###
+	start_frame = 1 # note: bpy.context.scene.frame_current may be helpful in the future
+	scene = bpy.context.scene
+	car = car or bpy.context.active_object
+	shared = shared and not track # every car takes its own path round a track
+
+	state = load_train(train_engine(car)) if incremental else None
+	rigs = update_traincars(state,spacing,amount,velo,derail,collectively,derail_type,derail_val,tolerance,shared,track) if state else None
+	if rigs:
+		if select:
+			select_rig([obj for rig in rigs for obj in rig], rigs[-1], scene)
+		if update:
+			scene.update()
+		return rigs
+
+	# principal engine car first, then every new car behind it
+	first_rig = rig = rig or template_rig(car)
+	if proxy: # collision shape to simulate with instead of the car itself
+		rig = make_proxy_rig(rig, scene, proxy)
+	rigs = [rig]
+	links = constraint_map(rig) # once, every copy is wired the same way
+	for i in range(amount):
+		current_car, new_car, rig = duplicate(spacing, rig, scene, single_user=not shared, links=links)
+		rigs.append(rig)
+	cars = [rig[0] for rig in rigs]
+
+	if track:
+		keys = KeyframeBatch()
+		end_frames = track_motion(rigs, Track(scene.objects[track], scene), start_frame, spacing, velo, derail, collectively, derail_type, derail_val, tolerance, keys)
+		keys.write()
+	else:
+		end_frames = [None]*len(cars)
+		if derail:
+			end_frames = derail_frames(cars, velo, derail_type, derail_val, collectively, tolerance)
+
+		if shared:
+			share_motion(cars, end_frames, start_frame, velo, derail)
+		else:
+			# collected for every car and written curve by curve at the end
+			keys = KeyframeBatch()
+			key_cars(cars, end_frames, start_frame, velo, derail, keys)
+			keys.write()
+
+	save_train(rigs, start_frame, spacing, velo, derail, end_frames, shared, track)
+	if select and (amount or proxy):
+		select_rig(first_rig + rigs[0], rig, scene)
+	if update:
+		scene.update() # once, for every car made above
+	return rigs
+
+
+###
+# Trajectory files
+#  a generated train's keyframes (kinematic switches included), where each rig
+#  object sits and the constraint wiring in one .npz, so the same layout can go
+#  on a rig in another shot without generating it again. Keys from every car's
+#  curves are stored end to end, with each curve's car, data path and key count
+#  alongside
+###
+
+TRAJECTORY_VERSION = 1
+EXTRAPOLATION = {'CONSTANT':0, 'LINEAR':1}
+
+
+def key_interpolation(points):
+	ipo = np.empty(len(points), dtype=np.int32)
+	try:
+		points.foreach_get('interpolation', ipo)
+	except (TypeError, RuntimeError): # older builds can't bulk access enum properties
+		ipo[:] = [INTERPOLATION.get(point.interpolation, INTERPOLATION['BEZIER']) for point in points]
+	return ipo
+
+
+def replace_keyframes(curve, co, ipo):
+	# swap all of curve's keys for these, in bulk
+	points = curve.keyframe_points
+	if hasattr(points, 'clear'):
+		points.clear()
+	else: # older builds, trim off the end where removing is cheap
+		for i in range(len(points)):
+			points.remove(points[-1], fast=True)
+	points.add(len(co))
+	points.foreach_set('co', np.ascontiguousarray(co, dtype=np.float32).ravel())
+	try:
+		points.foreach_set('interpolation', np.ascontiguousarray(ipo, dtype=np.int32))
+	except (TypeError, RuntimeError):
+		modes = {value: mode for mode, value in INTERPOLATION.items()}
+		for point, value in zip(points, ipo):
+			point.interpolation = modes.get(int(value), 'BEZIER')
+	curve.update()
+
+
+def export_train(rigs, state, path):
+	cars = [rig[0] for rig in rigs]
+	paths = []
+	curve_car, curve_path, curve_index, curve_extrapolation, curve_keys = [], [], [], [], []
+	co, ipo = [], []
+	for n, car in enumerate(cars):
+		action = car.animation_data.action if car.animation_data else None
+		for curve in (action.fcurves if action else ()):
+			points = curve.keyframe_points
+			keys = np.empty(len(points)*2, dtype=np.float32)
+			points.foreach_get('co', keys)
+			keys = keys.reshape(-1,2)
+			if curve.data_path not in paths:
+				paths.append(curve.data_path)
+			curve_car.append(n)
+			curve_path.append(paths.index(curve.data_path))
+			curve_index.append(curve.array_index)
+			curve_extrapolation.append(EXTRAPOLATION.get(curve.extrapolation, 0))
+			curve_keys.append(len(keys))
+			co.append(keys)
+			ipo.append(key_interpolation(points))
+
+	# constraint wiring as car numbers, -1 for anything that isn't one of the train's cars
+	number = {car.name: n for n, car in enumerate(cars)}
+	links = []
+	for r, rig in enumerate(rigs):
+		for i, obj in enumerate(rig):
+			constraint = obj.rigid_body_constraint
+			if constraint:
+				links.append((r, i,
+					number.get(constraint.object1.name, -1) if constraint.object1 else -1,
+					number.get(constraint.object2.name, -1) if constraint.object2 else -1))
+
+	np.savez_compressed(path,
+		version=np.array(TRAJECTORY_VERSION),
+		state=np.array(json.dumps(state)),
+		rig_size=np.array(len(rigs[0])),
+		rig_matrices=np.array([world_matrices(rig) for rig in rigs], dtype=np.float32),
+		paths=np.array(paths, dtype=str),
+		curve_car=np.array(curve_car, dtype=np.int32),
+		curve_path=np.array(curve_path, dtype=np.int32),
+		curve_index=np.array(curve_index, dtype=np.int32),
+		curve_extrapolation=np.array(curve_extrapolation, dtype=np.int8),
+		curve_keys=np.array(curve_keys, dtype=np.int32),
+		key_co=np.concatenate(co) if co else np.empty((0,2), dtype=np.float32),
+		key_interpolation=np.concatenate(ipo).astype(np.int8) if ipo else np.empty(0, dtype=np.int8),
+		links=np.array(links, dtype=np.int32).reshape(-1,4),
+	)
+
+
+def import_train(rig, path, scene):
+	###
+	# Lays a saved train out from rig: rig is duplicated once per car in the
+	#  file, then each car's curves get the saved keys and each constraint the
+	#  saved wiring. Returns every car's rig
+	###
+	with np.load(path) as data:
+		data = {name: data[name] for name in data.files}
+	if int(data['version']) > TRAJECTORY_VERSION:
+		raise ValueError("{} was written by a newer traincar".format(path))
+	if int(data['rig_size']) != len(rig):
+		raise ValueError("{} needs a rig of {} objects, not {}".format(path, int(data['rig_size']), len(rig)))
+	# the same objects of the rig have to be constraints, before anything gets made
+	saved = sorted(set(int(i) for i in data['links'][:,1]))
+	here = [i for i, obj in enumerate(rig) if obj.rigid_body_constraint]
+	if saved != here:
+		raise ValueError("{} has constraints at rig objects {}, this rig at {}".format(path, saved, here))
+	state = json.loads(str(data['state']))
+	if len(data['curve_car']) and int(data['curve_car'].max()) >= len(state['rigs']):
+		raise ValueError("{} has keys for more cars than its train".format(path))
+
+	rigs = [rig]
+	for i in range(len(state['rigs'])-1):
+		current_car, new_car, rig = duplicate(state['spacing'], rig, scene, links=[]) # wired from the file below
+		rigs.append(rig)
+	cars = [rig[0] for rig in rigs]
+
+	ends = np.cumsum(data['curve_keys'])
+	extrapolation = {value: mode for mode, value in EXTRAPOLATION.items()}
+	for c, (n, p, index, end) in enumerate(zip(data['curve_car'], data['curve_path'], data['curve_index'], ends)):
+		car = cars[n]
+		if not car.animation_data:
+			car.animation_data_create()
+		if not car.animation_data.action:
+			car.animation_data.action = bpy.data.actions.new(car.name + "-Action")
+		fcurves = car.animation_data.action.fcurves
+		data_path = str(data['paths'][p])
+		curve = fcurves.find(data_path, int(index)) or fcurves.new(data_path, index=int(index), action_group="train")
+		curve.extrapolation = extrapolation[int(data['curve_extrapolation'][c])]
+		start = end - data['curve_keys'][c]
+		replace_keyframes(curve, data['key_co'][start:end], data['key_interpolation'][start:end])
+
+	# constraint objects and the like go back where they were, e.g. along a track.
+	#  The cars themselves follow their keys
+	if 'rig_matrices' in data: # not in files from before it was written
+		for rig, matrices in zip(rigs, data['rig_matrices']):
+			for obj, matrix in zip(rig[1:], matrices[1:]):
+				if not (obj.parent and obj.parent in rig): # children ride along with their parent
+					obj.matrix_world = Matrix([list(row) for row in matrix])
+
+	for r, i, one, two in data['links']:
+		constraint = rigs[r][i].rigid_body_constraint
+		if one >= 0:
+			constraint.object1 = cars[one]
+		if two >= 0:
+			constraint.object2 = cars[two]
+
+	save_train(rigs, state['start_frame'], state['spacing'], state['velo'], state['derail'], state['ends'], False, state.get('track'))
+	return rigs
+
+
+###
+# Rigid body world tuning
+#  short trial bakes of a generated train at a range of substep and solver
+#  iteration settings, cheapest first. A setting is stable when no constraint
+#  pulls apart further than max_separation and no car moves faster than
+#  max_speed in a frame. The cheapest stable setting goes on the scene's world
+###
+
+TUNE_STEPS = (60, 120, 240, 480)
+TUNE_ITERATIONS = (10, 20, 40, 80)
+
+
+def train_links(rigs):
+	# every constraint object in the train with both of its bodies set
+	return [obj for rig in rigs for obj in rig if obj.rigid_body_constraint and
+		obj.rigid_body_constraint.object1 and obj.rigid_body_constraint.object2]
+
+
+def world_matrices(objects):
+	return np.array([[list(row) for row in obj.matrix_world] for obj in objects]).reshape(-1,4,4)
+
+
+def link_pivots(links):
+	# each constraint's pivot in the space of both of its bodies, as things stand now
+	pivots = np.array([list(obj.matrix_world.translation) + [1] for obj in links])
+	ones = np.linalg.inv(world_matrices([obj.rigid_body_constraint.object1 for obj in links]))
+	twos = np.linalg.inv(world_matrices([obj.rigid_body_constraint.object2 for obj in links]))
+	return np.einsum('nij,nj->ni', ones, pivots), np.einsum('nij,nj->ni', twos, pivots)
+
+
+def trial_bake(scene, steps, iterations, frame_end):
+	world = scene.rigidbody_world
+	cache = world.point_cache
+	world.steps_per_second = steps
+	world.solver_iterations = iterations
+	override = {'scene': scene, 'point_cache': cache}
+	bpy.ops.ptcache.free_bake(override)
+	cache.frame_end = frame_end
+	clock = time.perf_counter()
+	bpy.ops.ptcache.bake(override, bake=True)
+	return time.perf_counter() - clock
+
+
+def trial_stability(scene, cars, links, pivots, frame_start, frame_end):
+	# worst constraint separation and fastest car over the baked frames
+	separation = 0.0
+	speed = 0.0
+	previous = None
+	for frame in range(frame_start, frame_end+1):
+		scene.frame_set(frame)
+		positions = world_matrices(cars)[:,:3,3]
+		if previous is not None:
+			speed = max(speed, float(np.linalg.norm(positions - previous, axis=1).max()))
+		previous = positions
+		if links:
+			one = np.einsum('nij,nj->ni', world_matrices([obj.rigid_body_constraint.object1 for obj in links]), pivots[0])
+			two = np.einsum('nij,nj->ni', world_matrices([obj.rigid_body_constraint.object2 for obj in links]), pivots[1])
+			separation = max(separation, float(np.linalg.norm(one[:,:3] - two[:,:3], axis=1).max()))
+		if not (np.isfinite(separation) and np.isfinite(speed)):
+			break
+	return separation, speed
+
+
+def tune_world(scene, rigs, trial_frames, max_separation, max_speed):
+	###
+	# Returns the cheapest stable (steps, iterations) or None, with every trial's
+	#  (steps, iterations, seconds, separation, speed). Settings at or above a
+	#  stable one on both counts can only cost more, so they are skipped
+	###
+	world = scene.rigidbody_world
+	cache = world.point_cache
+	saved = (world.steps_per_second, world.solver_iterations, cache.frame_end, cache.use_disk_cache, scene.frame_current)
+	cars = [rig[0] for rig in rigs]
+	links = train_links(rigs)
+
+	state = load_train(rigs[0][0])
+	ends = [end for end in (state['ends'] if state else []) if end is not None]
+	# long enough to see the train derail, when it does
+	frame_start = cache.frame_start
+	frame_end = min(saved[2], int(math.ceil(min(ends) if ends else frame_start)) + trial_frames)
+
+	scene.frame_set(frame_start)
+	pivots = link_pivots(links) if links else None
+	cache.use_disk_cache = False
+
+	trials = []
+	stable = []
+	try:
+		for steps, iterations in sorted(itertools.product(TUNE_STEPS, TUNE_ITERATIONS), key=lambda setting: setting[0]*setting[1]):
+			if any(steps >= s and iterations >= i for s,i in stable):
+				continue
+			seconds = trial_bake(scene, steps, iterations, frame_end)
+			separation, speed = trial_stability(scene, cars, links, pivots, frame_start, frame_end)
+			trials.append((steps, iterations, seconds, separation, speed))
+			if separation <= max_separation and speed <= max_speed:
+				stable.append((steps, iterations))
+	finally:
+		bpy.ops.ptcache.free_bake({'scene': scene, 'point_cache': cache})
+		world.steps_per_second, world.solver_iterations, cache.frame_end, cache.use_disk_cache = saved[:4]
+		scene.frame_set(saved[4])
+
+	timed = [trial for trial in trials if (trial[0], trial[1]) in stable]
+	best = min(timed, key=lambda trial: trial[2]) if timed else None
+	if best:
+		world.steps_per_second, world.solver_iterations = best[:2]
+	return (best[:2] if best else None), trials
+
+
+###
+# Profiling
+#  with TrainCarAdd's Profile option, or TRAINCAR_PROFILE set in the environment,
+#  generation runs inside a Profiler: the functions below are swapped for timed
+#  versions that also count the bpy.ops calls made under them. Phases nest, so
+#  their times overlap. TRAINCAR_PROFILE=1 (or true/yes/on) just times, 0 (or
+#  false/no/off) leaves it off, and any other value is a trace file to write
+#  as well: cProfile stats for .prof, JSON otherwise
+###
+
+PROFILE_ENV = 'TRAINCAR_PROFILE'
+PROFILE_PHASES = ('update_traincars', 'make_proxy_rig', 'duplicate', 'get_or_make_curves', 'derail_frames', 'find_collision_frame', 'track_motion', 'share_motion', 'save_train')
+PROFILE_DATA = ('objects', 'actions', 'meshes', 'groups', 'curves')
+
+# the last profiled run, for the Traincar panel
+profile_summary = {}
+
+
+def op_class():
+	# what bpy.ops.x.y hands back, its __call__ runs the operator
+	import bpy.ops
+	return getattr(bpy.ops, 'BPyOpsSubModOp', None) or getattr(bpy.ops, '_BPyOpsSubModOp')
+
+
+def datablock_counts():
+	return {kind: len(getattr(bpy.data, kind)) for kind in PROFILE_DATA}
+
+
+PROFILE_OFF = ('', '0', 'false', 'no', 'off')
+PROFILE_ON = ('1', 'true', 'yes', 'on')
+
+
+def profile_trace(enabled=False, trace=""):
+	# whether to profile, and where to write a trace (None for nowhere)
+	env = os.environ.get(PROFILE_ENV, "").strip()
+	switch = env.lower()
+	if not (enabled or switch not in PROFILE_OFF):
+		return False, None
+	return True, trace or (env if switch not in PROFILE_OFF + PROFILE_ON else None)
+
+
+class Profiler(object):
+	"""Times traincar's phases and counts bpy.ops calls and new datablocks, while in a with block"""
+
+	def __init__(self, trace=None):
+		self.trace = trace
+		self.phases = {}
+		self.stack = []
+		self.ops_outside = 0
+		self.seconds = 0.0
+		self.created = {}
+		self.patched = []
+		self.profile = None
+
+	def phase(self, name):
+		return self.phases.setdefault(name, {'seconds': 0.0, 'calls': 0, 'ops': 0})
+
+	def wrap(self, name, func):
+		recorder = self
+		def timed(*args, **kwargs):
+			recorder.stack.append(name)
+			start = time.perf_counter()
+			try:
+				return func(*args, **kwargs)
+			finally:
+				elapsed = time.perf_counter() - start
+				recorder.stack.pop()
+				phase = recorder.phase(name)
+				phase['calls'] += 1
+				if name not in recorder.stack: # don't double count recursion
+					phase['seconds'] += elapsed
+		return timed
+
+	def count_op(self):
+		for name in set(self.stack):
+			self.phase(name)['ops'] += 1
+		if not self.stack:
+			self.ops_outside += 1
+
+	def patch(self, owner, attr, replacement):
+		original = owner[attr] if isinstance(owner, dict) else getattr(owner, attr)
+		self.patched.append((owner, attr, original))
+		if isinstance(owner, dict):
+			owner[attr] = replacement(original)
+		else:
+			setattr(owner, attr, replacement(original))
+
+	def __enter__(self):
+		namespace = globals() # what traincar's functions look each other up in
+		for name in PROFILE_PHASES:
+			self.patch(namespace, name, lambda func, name=name: self.wrap(name, func))
+		self.patch(KeyframeBatch, 'write', lambda func: self.wrap('keyframes', func))
+		recorder = self
+		def counted(call):
+			def call_op(op, *args, **kwargs):
+				recorder.count_op()
+				return call(op, *args, **kwargs)
+			return call_op
+		self.patch(op_class(), '__call__', counted)
+
+		self.before = datablock_counts()
+		if self.trace and self.trace.endswith('.prof'):
+			self.profile = cProfile.Profile()
+			self.profile.enable()
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *exc):
+		self.seconds = time.perf_counter() - self.start
+		if self.profile:
+			self.profile.disable()
+		for owner, attr, original in reversed(self.patched):
+			if isinstance(owner, dict):
+				owner[attr] = original
+			else:
+				setattr(owner, attr, original)
+		del self.patched[:]
+		after = datablock_counts()
+		self.created = {kind: after[kind] - self.before[kind] for kind in after}
+
+		if self.profile:
+			self.profile.dump_stats(self.trace)
+		elif self.trace:
+			with open(self.trace, 'w') as f:
+				json.dump(self.report(), f, indent=1, sort_keys=True)
+		return False
+
+	def report(self):
+		return {
+			'seconds': self.seconds,
+			'phases': self.phases,
+			'ops_outside_phases': self.ops_outside,
+			'created': self.created,
+		}
+
+
+###
+# Command line
+#  blender -b scene.blend -P traincar.py -- trains.json [--output out.blend] [--bake] [--report timings.json]
+#
+#  Lays out every train spec in the file, then updates and saves the scene once.
+#  Specs are read one at a time from a JSON array, JSON objects one per line, or
+#  CSV with a header row (vectors written as "x y z"). Keys follow TrainCarAdd:
+#   object (required), rig, n, spacing, velocity, derail, collectively,
+#   derail_at, derail_obj, derail_obj_type, derail_group, derail_loc,
+#   derail_frame, derail_frame_spacing, tolerance, shared, proxy, track, incremental
+###
+
+SPEC_DEFAULTS = {
+	'rig': None,
+	'n': 1,
+	'spacing': (0,0,0),
+	'velocity': (0,0,0),
+	'derail': False,
+	'collectively': True,
+	'derail_at': 'OBJ',
+	'derail_obj': '',
+	'derail_obj_type': 'LOC',
+	'derail_group': '',
+	'derail_loc': (0,0,0),
+	'derail_frame': 10,
+	'derail_frame_spacing': 1.0,
+	'tolerance': 2.0,
+	'shared': False,
+	'proxy': None,
+	'track': None,
+	'incremental': False,
+}
+
+# how to read each CSV column
+SPEC_COLUMNS = {
+	'rig': lambda text: text.split(),
+	'n': int,
+	'spacing': lambda text: [float(v) for v in text.split()],
+	'velocity': lambda text: [float(v) for v in text.split()],
+	'derail': lambda text: text.strip().lower() in ('1','true','yes'),
+	'collectively': lambda text: text.strip().lower() in ('1','true','yes'),
+	'derail_loc': lambda text: [float(v) for v in text.split()],
+	'derail_frame': int,
+	'derail_frame_spacing': float,
+	'tolerance': float,
+	'shared': lambda text: text.strip().lower() in ('1','true','yes'),
+	'incremental': lambda text: text.strip().lower() in ('1','true','yes'),
+}
+
+
+def stream_json(f, chunk_size=65536):
+	# yields each object of a JSON array or of concatenated/line separated JSON objects, without reading it all in
+	decoder = json.JSONDecoder()
+	buffer = ''
+	for chunk in iter(lambda: f.read(chunk_size), ''):
+		buffer += chunk
+		while True:
+			buffer = buffer.lstrip(' \t\r\n,[]')
+			try:
+				spec, end = decoder.raw_decode(buffer)
+			except ValueError: # incomplete, wait for more
+				break
+			buffer = buffer[end:]
+			yield spec
+	if buffer.lstrip(' \t\r\n,[]'):
+		raise ValueError("trailing data that isn't a train spec: " + buffer[:80])
+
+
+def read_specs(path):
+	with open(path, newline='') as f:
+		if path.lower().endswith('.csv'):
+			for row in csv.DictReader(f):
+				yield {key: SPEC_COLUMNS.get(key, str)(value) for key,value in row.items() if value not in (None, '')}
+		else:
+			for spec in stream_json(f):
+				yield spec
+
+
+def make_train_from_spec(spec, scene):
+	unknown = sorted(key for key in spec if key != 'object' and key not in SPEC_DEFAULTS)
+	if unknown: # a typo would otherwise quietly make a different train
+		raise ValueError("unknown spec key {}".format(", ".join(repr(key) for key in unknown)))
+	settings = dict(SPEC_DEFAULTS)
+	settings.update(spec)
+	# everything the spec names has to be there, before anything gets made
+	names = [settings['object']] + list(settings['rig'] or [])
+	if settings['track']:
+		names.append(settings['track'])
+	missing = [name for name in names if name not in scene.objects]
+	if missing:
+		raise KeyError("no object {} in the scene".format(", ".join(repr(name) for name in missing)))
+	if settings['track'] and scene.objects[settings['track']].type != 'CURVE':
+		raise ValueError("track {} is not a curve".format(settings['track']))
+	car = scene.objects[settings['object']]
+	if car.rigid_body is None:
+		raise ValueError("{} has no rigid body".format(car.name))
+	rig = [scene.objects[name] for name in settings['rig']] if settings['rig'] else attached_rig(car, scene)
+	return do_traincars(
+		spacing=settings['spacing'],
+		amount=settings['n'],
+		velo=settings['velocity'],
+		derail=settings['derail'],
+		collectively=settings['collectively'],
+		derail_type=derail_type(settings['derail_at'], settings['derail_obj_type']),
+		derail_val=derail_val(settings['derail_at'], settings['derail_obj'], settings['derail_group'], settings['derail_loc'], settings['derail_frame'], settings['derail_frame_spacing']),
+		tolerance=settings['tolerance'],
+		incremental=settings['incremental'],
+		shared=settings['shared'],
+		proxy=settings['proxy'],
+		track=settings['track'],
+		car=car,
+		rig=rig,
+		update=False,
+		select=False
+	)
 
 
+def main(argv):
+	parser = argparse.ArgumentParser(
+		prog="blender -b scene.blend -P traincar.py --",
+		description="Lay out many trains from a file of train specs")
+	parser.add_argument('specs', help="JSON (array, or one object per line) or CSV file of train specs")
+	parser.add_argument('--output', help="save to this .blend instead of over the opened one")
+	parser.add_argument('--bake', action='store_true', help="bake the rigid body simulation to disk after saving")
+	parser.add_argument('--report', help="write timings for this run to a JSON file")
+	args = parser.parse_args(argv)
+
+	report = {'made': 0, 'failed': 0}
+	clock = time.perf_counter()
+	profiling, trace = profile_trace()
+	profiler = Profiler(trace) if profiling else None
+
+	scene = bpy.context.scene
+	with profiler or contextlib.ExitStack():
+		for n, spec in enumerate(read_specs(args.specs), 1):
+			before = set(scene.objects.keys())
+			try:
+				make_train_from_spec(spec, scene)
+				report['made'] += 1
+			except Exception as e:
+				# don't save half a train
+				remove_rig([obj for obj in scene.objects if obj.name not in before])
+				report['failed'] += 1
+				print("traincar: spec {} skipped: {!r}".format(n, e))
+		scene.update() # once, for every train
+	report['generate_seconds'] = time.perf_counter() - clock
+	if profiler:
+		report['profile'] = profiler.report()
+
+	def save():
+		clock = time.perf_counter()
+		if args.output:
+			bpy.ops.wm.save_as_mainfile(filepath=bpy.path.abspath(args.output))
+		else:
+			bpy.ops.wm.save_mainfile()
+		report['save_seconds'] = report.get('save_seconds', 0) + time.perf_counter() - clock
+	save()
+
+	if args.bake and scene.rigidbody_world:
+		# disk cache lands in blendcache_<file>/ next to the saved .blend
+		cache = scene.rigidbody_world.point_cache
+		cache.use_disk_cache = True
+		clock = time.perf_counter()
+		bpy.ops.ptcache.bake({'scene': scene, 'point_cache': cache}, bake=True)
+		report['bake_seconds'] = time.perf_counter() - clock
+		report['bake_frames'] = [cache.frame_start, cache.frame_end]
+		save()
+
+	report['blend'] = bpy.data.filepath
+	if args.report:
+		with open(args.report, 'w') as f:
+			json.dump(report, f, indent=1, sort_keys=True)
+	print("traincar: made {} trains, {} failed".format(report['made'], report['failed']))
+	if report['failed']:
+		sys.exit(1)
 
 
 def register():
 	bpy.utils.register_class(TrainCarPanel)
 	bpy.utils.register_class(TrainCarAdd)
+	bpy.utils.register_class(TrainCarTune)
+	bpy.utils.register_class(TrainCarExport)
+	bpy.utils.register_class(TrainCarImport)
 def unregister():
 	bpy.utils.unregister_class(TrainCarPanel)
 	bpy.utils.unregister_class(TrainCarAdd)
+	bpy.utils.unregister_class(TrainCarTune)
+	bpy.utils.unregister_class(TrainCarExport)
+	bpy.utils.unregister_class(TrainCarImport)
 
 if __name__ == "__main__":
-	register()
+	if '--' in sys.argv:
+		main(sys.argv[sys.argv.index('--')+1:])
+	else:
+		register()
 
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+"""
+traincar_bench.py -- scaling benchmarks for traincar.py generation
+
+Copyright (c) 2016 Dan Panzarella <alsoelp@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+"""
+	Run from a regular python, pointing at a blender binary:
+
+		python traincar_bench.py --blender /path/to/blender --out bench.json
+
+	Every case (car count x timeline length x derail mode) runs in its own
+	fresh background blender, so peak memory is per case. Results go to
+	JSON, and --compare against an older run prints how each case moved.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+
+try:
+	import bpy
+except ImportError: # the driver side, outside of blender
+	bpy = None
+
+try:
+	import resource
+except ImportError: # not on windows
+	resource = None
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RESULT_MARKER = "TRAINCAR_BENCH "
+
+MODES = ('NONE','FRAME','LOC','OBJ','BOUND','GROUP')
+CARS = (10, 100, 1000, 10000)
+FRAMES = (250, 2500)
+
+SPACING = (0,-3,0)
+VELOCITY = (0,0.5,0)
+
+
+###
+# Inside blender
+###
+
+def peak_memory():
+	# kilobytes on linux, bytes on mac
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None
+
+
+def build_scene(case):
+	# engine car with a hinge to the next car, plus obstacles down the track
+	scene = bpy.context.scene # factory startup scene, emptied out
+	for obj in list(scene.objects):
+		scene.objects.unlink(obj)
+	scene.frame_start = 1
+	scene.frame_end = case['frames']
+	if not scene.rigidbody_world:
+		bpy.ops.rigidbody.world_add()
+
+	bpy.ops.mesh.primitive_cube_add(location=(0,0,1))
+	car = bpy.context.active_object
+	car.name = "Car"
+	bpy.ops.rigidbody.object_add()
+
+	bpy.ops.object.empty_add(location=(0,-1.5,1))
+	hinge = bpy.context.active_object
+	hinge.name = "Hinge"
+	bpy.ops.rigidbody.constraint_add(type='HINGE')
+	hinge.rigid_body_constraint.object1 = car
+
+	# halfway down the timeline
+	crash = VELOCITY[1] * case['frames'] / 2
+	obstacles = bpy.data.groups.new("Obstacles")
+	for i in range(8):
+		bpy.ops.mesh.primitive_ico_sphere_add(size=1.5, location=(0, crash + i*10, 1))
+		obstacle = bpy.context.active_object
+		obstacle.name = "Obstacle"
+		obstacles.objects.link(obstacle)
+
+	for obj in scene.objects:
+		obj.select = obj in (car, hinge)
+	scene.objects.active = car
+	return scene
+
+
+def derail_settings(case):
+	mode = case['mode']
+	if mode == 'NONE':
+		return dict(derail=False)
+	if mode == 'FRAME':
+		return dict(derail=True, collectively=False, derail_type='FRAME', derail_val=(case['frames']//2, 1.0))
+	if mode == 'LOC':
+		return dict(derail=True, collectively=False, derail_type='LOC', derail_val=(0, VELOCITY[1]*case['frames']/2, 1))
+	if mode == 'GROUP':
+		return dict(derail=True, collectively=False, derail_type='OBJ', derail_val=[obj.name for obj in bpy.data.groups["Obstacles"].objects])
+	return dict(derail=True, collectively=False, derail_type=mode, derail_val="Obstacle")
+
+
+def run_case(case):
+	sys.path.insert(0, HERE)
+	import traincar
+
+	build_scene(case)
+
+	memory_before = peak_memory()
+	with traincar.Profiler() as profiler:
+		traincar.do_traincars(
+			spacing=SPACING,
+			amount=case['cars'],
+			velo=VELOCITY,
+			**derail_settings(case)
+		)
+
+	result = dict(case)
+	result.update(profiler.report())
+	result.update({
+		'peak_memory': peak_memory(),
+		'peak_memory_before': memory_before,
+		'blender': bpy.app.version_string,
+	})
+	print(RESULT_MARKER + json.dumps(result))
+	sys.stdout.flush()
+
+
+###
+# Driver, outside blender
+###
+
+def git_commit():
+	try:
+		return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=HERE, stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def launch(blender, case, timeout):
+	command = [blender, '-b', '--factory-startup', '--python', os.path.abspath(__file__), '--', '--case', json.dumps(case)]
+	try:
+		output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=timeout).stdout.decode(errors='replace')
+	except subprocess.TimeoutExpired:
+		return dict(case, error="timed out after {}s".format(timeout))
+	for line in output.splitlines():
+		if line.startswith(RESULT_MARKER):
+			return json.loads(line[len(RESULT_MARKER):])
+	return dict(case, error=output[-2000:])
+
+
+def case_key(result):
+	return (result['mode'], result['cars'], result['frames'])
+
+
+def compare(results, old_path):
+	with open(old_path) as f:
+		old = {case_key(r): r for r in json.load(f)['results'] if 'seconds' in r}
+	print("{:>6} {:>6} {:>6} {:>10} {:>10} {:>7}".format('mode','cars','frames','before','now','ratio'))
+	for result in results:
+		previous = old.get(case_key(result))
+		if 'seconds' not in result or not previous:
+			continue
+		print("{:>6} {:>6} {:>6} {:>10.3f} {:>10.3f} {:>7.2f}".format(
+			result['mode'], result['cars'], result['frames'],
+			previous['seconds'], result['seconds'], result['seconds'] / max(previous['seconds'], 1e-9)))
+
+
+def number_list(text):
+	return [int(n) for n in text.split(',') if n]
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Sweep traincar generation over car count, timeline length and derail mode")
+	parser.add_argument('--blender', default='blender', help="blender binary to run cases with")
+	parser.add_argument('--cars', type=number_list, default=list(CARS), help="comma separated car counts")
+	parser.add_argument('--frames', type=number_list, default=list(FRAMES), help="comma separated timeline lengths")
+	parser.add_argument('--modes', type=lambda text: text.upper().split(','), default=list(MODES), help="comma separated derail modes: " + ",".join(MODES))
+	parser.add_argument('--timeout', type=float, default=3600, help="seconds before giving up on a case")
+	parser.add_argument('--out', default='traincar_bench.json', help="where to write results")
+	parser.add_argument('--compare', help="earlier results file to compare against")
+	args = parser.parse_args(argv)
+
+	results = []
+	for mode, frames, cars in itertools.product(args.modes, args.frames, args.cars):
+		case = {'mode': mode, 'cars': cars, 'frames': frames}
+		result = launch(args.blender, case, args.timeout)
+		results.append(result)
+		print("{mode:>6} {cars:>6} cars {frames:>6} frames: ".format(**case) +
+			("{:.3f}s".format(result['seconds']) if 'seconds' in result else "failed"))
+
+	with open(args.out, 'w') as f:
+		json.dump({'commit': git_commit(), 'time': time.time(), 'results': results}, f, indent=1, sort_keys=True)
+
+	if args.compare:
+		compare(results, args.compare)
+
+
+if __name__ == "__main__":
+	argv = sys.argv[sys.argv.index('--')+1:] if '--' in sys.argv else sys.argv[1:]
+	if bpy:
+		case_arg = argv.index('--case')
+		run_case(json.loads(argv[case_arg+1]))
+	else:
+		main(argv)
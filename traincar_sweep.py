@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""
+traincar_sweep.py -- parallel parameter sweeps of traincar.py derail scenarios
+
+Copyright (c) 2016 Dan Panzarella <alsoelp@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+"""
+	Run from a regular python:
+
+		python traincar_sweep.py sweep.json --blender /path/to/blender --workers 8
+
+	where sweep.json names the scene, a base train spec (same keys as the
+	traincar.py command line) and the values to sweep:
+
+		{
+			"blend": "crash.blend",
+			"base": {"object": "Car", "n": 100, "spacing": [0,-3,0], "derail": true, "derail_at": "FRAME"},
+			"grid": {"velocity": [[0,0.3,0],[0,0.5,0]], "derail_frame": [30,40], "derail_frame_spacing": [0.5,1,2]}
+		}
+
+	Every combination becomes a variant, made and baked by its own background
+	blender. Each variant's .blend and baked cache end up in its own folder
+	under --out, next to a sweep.json report with every variant's timings.
+"""
+
+import argparse
+import concurrent.futures
+import itertools
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def expand(sweep):
+	# every combination of the grid values on top of the base spec, in a stable order
+	grid = sweep.get('grid', {})
+	names = sorted(grid)
+	for values in itertools.product(*(grid[name] for name in names)):
+		spec = dict(sweep.get('base', {}))
+		spec.update(zip(names, values))
+		yield dict(zip(names, values)), spec
+
+
+def run_variant(blender, blend, threads, folder, spec, timeout):
+	os.makedirs(folder, exist_ok=True)
+	spec_path = os.path.join(folder, 'spec.json')
+	report_path = os.path.join(folder, 'report.json')
+	with open(spec_path, 'w') as f:
+		json.dump(spec, f)
+
+	command = [
+		blender, '-b', blend, '-t', str(threads),
+		'--python-exit-code', '1', # blender exits 0 after a script error otherwise
+		'-P', os.path.join(HERE, 'traincar.py'), '--',
+		spec_path,
+		'--output', os.path.join(folder, 'variant.blend'),
+		'--bake',
+		'--report', report_path,
+	]
+	start = time.perf_counter()
+	try:
+		with open(os.path.join(folder, 'blender.log'), 'w') as log:
+			returncode = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT, timeout=timeout)
+	except subprocess.TimeoutExpired:
+		returncode = None
+	result = {'seconds': time.perf_counter() - start, 'returncode': returncode, 'folder': folder}
+
+	if os.path.exists(report_path):
+		with open(report_path) as f:
+			result.update(json.load(f))
+	# a skipped spec still exits 0 from older blenders, and no report means it never got that far
+	result['ok'] = returncode == 0 and os.path.exists(report_path) and not result.get('failed')
+	cache = os.path.join(folder, 'blendcache_variant')
+	result['cache_files'] = sorted(os.listdir(cache)) if os.path.isdir(cache) else []
+	return result
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Make and bake every variant of a traincar derail scenario in parallel")
+	parser.add_argument('sweep', help="JSON file with blend, base and grid")
+	parser.add_argument('--blender', default='blender', help="blender binary")
+	parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help="blender processes at once")
+	parser.add_argument('--threads', type=int, default=0, help="threads per blender (default: cores / workers)")
+	parser.add_argument('--timeout', type=float, default=None, help="seconds before giving up on a variant")
+	parser.add_argument('--out', default='sweep', help="folder for the variants and the report")
+	args = parser.parse_args(argv)
+
+	with open(args.sweep) as f:
+		sweep = json.load(f)
+	blend = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(args.sweep)), sweep['blend']))
+	threads = args.threads or max(1, multiprocessing.cpu_count() // args.workers)
+	variants = list(expand(sweep))
+	os.makedirs(args.out, exist_ok=True)
+
+	print("{} variants, {} at a time".format(len(variants), args.workers))
+	start = time.perf_counter()
+	results = [None]*len(variants)
+	# each worker thread just waits on its own blender process
+	with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as pool:
+		jobs = {}
+		for n, (params, spec) in enumerate(variants):
+			folder = os.path.abspath(os.path.join(args.out, 'variant_{:03d}'.format(n)))
+			jobs[pool.submit(run_variant, args.blender, blend, threads, folder, spec, args.timeout)] = (n, params)
+		for job in concurrent.futures.as_completed(jobs):
+			n, params = jobs[job]
+			result = job.result()
+			result['params'] = params
+			results[n] = result
+			print("variant {:03d} {} {:.1f}s{}".format(n, json.dumps(params, sort_keys=True), result['seconds'],
+				"" if result['ok'] else " FAILED (see {})".format(os.path.join(result['folder'], 'blender.log'))))
+
+	report = {
+		'blend': blend,
+		'workers': args.workers,
+		'threads': threads,
+		'seconds': time.perf_counter() - start,
+		'variants': results,
+	}
+	with open(os.path.join(args.out, 'sweep.json'), 'w') as f:
+		json.dump(report, f, indent=1, sort_keys=True)
+	print("done in {:.1f}s, serial time {:.1f}s".format(report['seconds'], sum(r['seconds'] for r in results)))
+
+	if not all(r['ok'] for r in results):
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])